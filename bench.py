@@ -0,0 +1,595 @@
+#!/usr/bin/env python3
+"""
+Benchmark harness for the alert bot.
+
+Runs local stand-ins for Moralis, Birdeye, GoPlus, Solana RPC and the
+Telegram Bot API in a separate process, points main.py at them through its
+*_URL environment variables, and drives the real pump scanner, DEX scanner
+and broadcast path, the pump.fun websocket ingest against a mock
+logsSubscribe server, plus webhook updates posted to the bot's own HTTP
+server. Each scenario runs in a fresh process so CPU time and
+peak RSS belong to that scenario alone. The "equiv" scenario is a
+correctness check rather than a benchmark: the NumPy paths against the
+per-token code, and `main.py backtest` against live decide() replay.
+
+    python bench.py --users 10000 --tokens 500 --duration 30 --out results.json
+
+Results are a JSON document (one entry per scenario) meant to be diffed
+between versions.
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import re
+import resource
+import string
+import sys
+import tempfile
+import time
+
+from aiohttp import web
+import aiohttp
+
+ALPHABET = string.ascii_letters + string.digits
+LINK_RE = re.compile(r"(?:pump\.fun|dexscreener\.com/\w+)/([A-Za-z0-9]+)")
+SCENARIOS = ("pump", "dex", "broadcast", "ws", "webhook", "equiv")
+PUMP_CREATE_DISC = hashlib.sha256(b"event:CreateEvent").digest()[:8]
+PUMP_TRADE_DISC = hashlib.sha256(b"event:TradeEvent").digest()[:8]
+PUMP_K = 30 * 10**9 * 1_073_000_000 * 10**6  # bonding curve: virtual SOL x virtual tokens
+B58 = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+
+def rand_addr(n=44):
+    return "".join(random.choices(ALPHABET, k=n))
+
+def b58(raw):
+    n, out = int.from_bytes(raw, "big"), ""
+    while n:
+        n, r = divmod(n, 58)
+        out = B58[r] + out
+    return out
+
+def u64(n):
+    return n.to_bytes(8, "little")
+
+def create_logs(sym, mint):
+    # pump.fun CreateEvent: discriminator, name, symbol, uri, then the mint
+    def field(text):
+        raw = text.encode()
+        return len(raw).to_bytes(4, "little") + raw
+    event = PUMP_CREATE_DISC + field(sym) + field(sym) + field("ipfs://x") + mint + bytes(64)
+    return ["Program log: Instruction: Create", "Program data: " + base64.b64encode(event).decode()]
+
+def trade_logs(mint, lamports, is_buy, vsol):
+    # pump.fun TradeEvent: mint, sol/token amounts, side, user, time, reserves
+    vtok = PUMP_K // vsol
+    event = (PUMP_TRADE_DISC + mint + u64(lamports) + u64(0) + bytes([is_buy]) + bytes(32)
+             + u64(int(time.time())) + u64(vsol) + u64(vtok) + bytes(16))
+    side = "Buy" if is_buy else "Sell"
+    return [f"Program log: Instruction: {side}", "Program data: " + base64.b64encode(event).decode()]
+
+def percentiles(values):
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "max": None}
+    values = sorted(values)
+    pick = lambda q: round(values[min(len(values) - 1, int(q * len(values)))], 4)
+    return {"p50": pick(0.5), "p95": pick(0.95), "p99": pick(0.99), "max": round(values[-1], 4)}
+
+# --------------------------------------------------------------------------- #
+#                               FAKE UPSTREAMS                              #
+# --------------------------------------------------------------------------- #
+class FakeUpstreams:
+    """
+    One aiohttp app serving every upstream. Each request waits ~latency,
+    fails with 500 at error_rate, and Telegram sends above rate_limit msg/s
+    get a 429 with retry_after. Token addresses are stamped when first
+    served, so a send that links to one yields the alert's end-to-end latency;
+    a "chat<id>" stamp does the same for the first reply sent to that chat.
+
+    The websocket streams pump.fun logs at ws_rate: launches, mostly-buy
+    trades on the latest launches (moving their bonding curves) and a ws_dup
+    share of repeats. It drops the connection after ws_drop_after messages;
+    ws_gap launches happen while the client is away and never reach it.
+    """
+    def __init__(self, latency, error_rate, rate_limit, tokens, fresh,
+                 ws_rate=20.0, ws_drop_after=50, ws_gap=10, ws_dup=0.1):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.tokens = tokens
+        self.fresh = fresh
+        self.ws_rate = ws_rate
+        self.ws_drop_after = ws_drop_after
+        self.ws_gap = ws_gap
+        self.ws_dup = ws_dup
+        self.pools = {}
+        self.reset()
+
+    def reset(self):
+        self.born = {}
+        self.requests = {}
+        self.errors = 0
+        self.throttled = 0
+        self.sends = 0
+        self.latencies = []
+        self.window = (0, 0)  # (second, sends in that second)
+        self.ws_stats = {"connections": 0, "launches": 0, "trades": 0, "repeats_sent": 0, "missed": 0}
+        self.ws_recent = []       # (signature, logs) already streamed
+        self.ws_curves = {}       # mint -> virtual SOL reserves, latest launches only
+        self.ws_mints = set()     # streamed launches, for launch-to-alert latency
+        self.launch_alerts = []
+
+    def app(self):
+        app = web.Application(middlewares=[self.middleware])
+        app.router.add_get("/token/mainnet/exchange/pumpfun/{feed}", self.moralis)
+        app.router.add_get("/token/mainnet/{address}/price", self.price)
+        app.router.add_get("/defi/v2.0/new_pairs", self.birdeye)
+        app.router.add_get("/api/v1/token_security/{chain_id}", self.goplus)
+        app.router.add_post("/solana", self.solana)
+        app.router.add_get("/ws", self.pump_ws)
+        app.router.add_post("/bot{token}/{method}", self.telegram)
+        app.router.add_get("/_stats", self.stats)
+        app.router.add_post("/_reset", self.do_reset)
+        app.router.add_post("/_born", self.mark_born)
+        return app
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        if request.path.startswith("/_") or request.path == "/ws":
+            return await handler(request)
+        route = request.match_info.route.resource.canonical if request.match_info.route.resource else "?"
+        self.requests[route] = self.requests.get(route, 0) + 1
+        if self.latency:
+            await asyncio.sleep(random.uniform(0.5, 1.5) * self.latency)
+        if random.random() < self.error_rate:
+            self.errors += 1
+            return web.json_response({"error": "injected"}, status=500)
+        return await handler(request)
+
+    def _batch(self, pool, n):
+        # keep a rolling pool: each call replaces a `fresh` share with new tokens
+        tokens = self.pools.setdefault(pool, [])
+        new = max(1, int(n * self.fresh)) if tokens else n
+        now = time.monotonic()
+        for _ in range(new):
+            addr = rand_addr()
+            self.born[addr] = now
+            tokens.insert(0, {
+                "addr": addr, "pair": rand_addr(), "sym": rand_addr(5).upper(),
+                "liq": random.uniform(0, 60_000), "fdv": random.uniform(0, 120_000),
+                "vol": random.uniform(0, 6_000),
+            })
+        del tokens[n:]
+        for t in tokens:
+            self.born.setdefault(t["pair"], self.born.get(t["addr"], now))
+        return tokens
+
+    async def moralis(self, request):
+        feed = request.match_info["feed"]
+        tokens = self._batch(f"moralis_{feed}", max(1, self.tokens // 2))
+        return web.json_response({"result": [{
+            "tokenAddress": t["addr"], "symbol": t["sym"], "fullyDilutedValuation": t["fdv"],
+            "liquidity": t["liq"], "volume_5m": t["vol"], "tags": ["new"] if feed == "new" else [],
+        } for t in tokens]})
+
+    async def price(self, request):
+        return web.json_response({"tokenAddress": request.match_info["address"], "usdPrice": 150.0})
+
+    async def birdeye(self, request):
+        chain = request.query.get("chain", "solana")
+        tokens = self._batch(f"birdeye_{chain}", self.tokens)
+        return web.json_response({"data": {"pairs": [{
+            "baseToken": {"address": t["addr"], "symbol": t["sym"]}, "pairAddress": t["pair"],
+            "liquidity": {"usd": t["liq"]}, "fdv": t["fdv"], "volume": {"m5": t["vol"]},
+        } for t in tokens]}})
+
+    async def goplus(self, request):
+        addrs = request.query.get("contract_addresses", "").split(",")
+        return web.json_response({"code": 1, "result": {
+            a.lower(): {"is_open_source": "1", "honeypot": "0", "can_take_back_ownership": "0"} for a in addrs if a
+        }})
+
+    async def solana(self, request):
+        payload = await request.json()
+
+        def answer(call):
+            if call.get("method") == "getSignaturesForAddress":
+                result = [{"signature": rand_addr(88)} for _ in range(3)]
+            elif call.get("method") == "getTransaction":
+                pre = random.randint(1, 50) * 10**9
+                result = {"meta": {"preBalances": [pre], "postBalances": [pre - random.randint(0, 20) * 10**9]}}
+            else:
+                result = None
+            return {"jsonrpc": "2.0", "id": call.get("id"), "result": result}
+
+        if isinstance(payload, list):
+            return web.json_response([answer(c) for c in payload])
+        return web.json_response(answer(payload))
+
+    async def telegram(self, request):
+        method = request.match_info["method"]
+        if method == "getMe":
+            return web.json_response({"ok": True, "result": {
+                "id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot",
+            }})
+        if method != "sendMessage":
+            return web.json_response({"ok": True, "result": True})
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        if self.rate_limit:
+            second = int(time.monotonic())
+            start, count = self.window
+            count = count + 1 if second == start else 1
+            self.window = (second, count)
+            if count > self.rate_limit:
+                self.throttled += 1
+                return web.json_response({
+                    "ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                    "parameters": {"retry_after": 1},
+                }, status=429)
+        text = str(params.get("text", ""))
+        self.sends += 1
+        m = LINK_RE.search(text)
+        if m and m.group(1) in self.born:
+            self.latencies.append(time.monotonic() - self.born[m.group(1)])
+            if m.group(1) in self.ws_mints:
+                self.ws_mints.discard(m.group(1))
+                self.launch_alerts.append(time.monotonic() - self.born[m.group(1)])
+        born = self.born.pop(f"chat{params.get('chat_id')}", None)
+        if born is not None:
+            self.latencies.append(time.monotonic() - born)
+        return web.json_response({"ok": True, "result": {
+            "message_id": self.sends, "date": int(time.time()),
+            "chat": {"id": int(params.get("chat_id", 0)), "type": "private"}, "text": text,
+        }})
+
+    def _launch(self):
+        mint = os.urandom(32)
+        addr = b58(mint)
+        self.born[addr] = time.monotonic()
+        self.ws_mints.add(addr)
+        self.ws_curves[mint] = 30 * 10**9
+        if len(self.ws_curves) > 20:
+            del self.ws_curves[next(iter(self.ws_curves))]
+        self.ws_stats["launches"] += 1
+        return create_logs(rand_addr(5).upper(), mint)
+
+    def _trade(self):
+        mint = random.choice(list(self.ws_curves))
+        is_buy = random.random() < 0.8
+        lamports = int(random.uniform(0.1, 3) * 10**9)
+        vsol = self.ws_curves[mint] + (lamports if is_buy else -lamports)
+        self.ws_curves[mint] = vsol = max(vsol, 30 * 10**9)
+        self.ws_stats["trades"] += 1
+        return trade_logs(mint, lamports, is_buy, vsol)
+
+    async def pump_ws(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.ws_stats["connections"] += 1
+        await ws.receive_json()  # logsSubscribe
+        await ws.send_json({"jsonrpc": "2.0", "result": 1, "id": 1})
+        for _ in range(self.ws_drop_after):
+            await asyncio.sleep(random.expovariate(self.ws_rate))
+            roll = random.random()
+            if self.ws_recent and roll < self.ws_dup:
+                sig, logs = random.choice(self.ws_recent)
+                self.ws_stats["repeats_sent"] += 1
+            else:
+                sig = rand_addr(88)
+                logs = self._trade() if self.ws_curves and roll < 0.8 else self._launch()
+            self.ws_recent = (self.ws_recent + [(sig, logs)])[-100:]
+            await ws.send_json({"jsonrpc": "2.0", "method": "logsNotification", "params": {"result": {
+                "context": {"slot": 1}, "value": {"signature": sig, "err": None, "logs": logs},
+            }}})
+        # the drop: these launch while the client reconnects
+        for _ in range(self.ws_gap):
+            self._launch()
+            self.ws_stats["missed"] += 1
+        await ws.close()
+        return ws
+
+    async def mark_born(self, request):
+        self.born[(await request.json())["addr"]] = time.monotonic()
+        return web.json_response({"ok": True})
+
+    async def stats(self, request):
+        return web.json_response({
+            "requests": self.requests, "injected_errors": self.errors,
+            "telegram_429": self.throttled, "messages": self.sends,
+            "e2e_latency_s": percentiles(self.latencies),
+            "ws": self.ws_stats, "launch_to_alert_s": percentiles(self.launch_alerts),
+        })
+
+    async def do_reset(self, request):
+        self.reset()
+        return web.json_response({"ok": True})
+
+def serve_fakes(port, args):
+    # scenarios are cut off mid-send; the resulting connection resets are noise
+    logging.getLogger("aiohttp.server").setLevel(logging.CRITICAL)
+    fakes = FakeUpstreams(args.latency, args.error_rate, args.rate_limit, args.tokens, args.fresh,
+                          args.ws_rate, args.ws_drop_after, args.ws_gap, args.ws_dup)
+    web.run_app(fakes.app(), host="127.0.0.1", port=port, print=None, access_log=None)
+
+# --------------------------------------------------------------------------- #
+#                                 SCENARIOS                                 #
+# --------------------------------------------------------------------------- #
+def bot_env(base, db_file, args):
+    return {
+        "BOT_TOKEN": "1:bench",
+        "MORALIS_API_KEY": "bench",
+        "DB_FILE": db_file,
+        "MORALIS_BASE_URL": base,
+        "BIRDEYE_BASE_URL": base,
+        "GOPLUS_BASE_URL": base,
+        "SOLANA_RPC": base + "/solana",
+        "BSCSCAN_API": base + "/bscscan",
+        "TELEGRAM_API_URL": base + "/bot",
+        "SEND_RATE": str(args.send_rate),
+        "PUMP_WS_URL": "",
+    }
+
+def seed_users(main, n):
+    chains = ["SOL", "BSC", "PUMP"]
+    for uid in range(1, n + 1):
+        main.users[uid] = {
+            "free": 0, "source": "bench", "paid": True, "paid_until": None, "test_sent": True,
+            "chat_id": uid,
+            "filters": {"levels": ["min", "medium", "max"], "chains": random.sample(chains, 2), "premium_only": False},
+        }
+    main.routing.rebuild()
+
+async def run_for(coro, seconds):
+    task = asyncio.ensure_future(coro)
+    try:
+        await asyncio.wait_for(asyncio.shield(task), seconds)
+    except asyncio.TimeoutError:
+        pass
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+def start_update(update_id, uid):
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": int(time.time()), "text": "/start",
+        "chat": {"id": uid, "type": "private"},
+        "from": {"id": uid, "is_bot": False, "first_name": "bench"},
+        "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+    }}
+
+async def post_updates(main, app, sess, base, args):
+    # /start from unseen users: each gets a welcome and a test alert back
+    runner = await main.start_http(args.port + 1, app)
+    await app.start()
+    local = f"http://127.0.0.1:{args.port + 1}"
+    url = local + main.WEBHOOK_PATH
+    headers = {"X-Telegram-Bot-Api-Secret-Token": main.WEBHOOK_SECRET}
+    async with sess.post(url, json=start_update(0, 0), headers={"X-Telegram-Bot-Api-Secret-Token": "x"}) as r:
+        bad_secret = r.status
+    post_times, statuses = [], {}
+    for i in range(1, args.updates + 1):
+        uid = args.users + i
+        await sess.post(base + "/_born", json={"addr": f"chat{uid}"})
+        t1 = time.monotonic()
+        async with sess.post(url, json=start_update(i, uid), headers=headers) as r:
+            statuses[r.status] = statuses.get(r.status, 0) + 1
+        post_times.append(time.monotonic() - t1)
+    deadline = time.monotonic() + args.duration
+    while time.monotonic() < deadline:
+        async with sess.get(base + "/_stats") as r:
+            if (await r.json())["messages"] >= 2 * args.updates:
+                break
+        await asyncio.sleep(0.05)
+    async with sess.get(local + "/readyz") as r:
+        ready = r.status
+    await app.stop()
+    await runner.cleanup()
+    return {"webhook_post_s": percentiles(post_times), "webhook_statuses": statuses,
+            "bad_secret_status": bad_secret, "readyz_status": ready}
+
+def without_numpy(main, fn, *a):
+    np, main.np = main.np, None
+    try:
+        return fn(*a)
+    finally:
+        main.np = np
+
+def random_snaps(main, addrs, n):
+    return [main.TokenSnapshot(chain, addr, "S", random.uniform(0, 60_000), random.uniform(0, 120_000),
+                               random.choice([0, random.uniform(0, 6_000)]))
+            for chain, addr in random.sample(addrs, n)]
+
+def check_equivalence(main, args, cycles=40):
+    """
+    Drive random polls through both classification paths and a live-style
+    replay (rings -> classify_batch -> TokenAlertState.decide) that records
+    history exactly as the scanners do, then backtest that history.
+    Every count below must match.
+    """
+    if main.np is None:
+        return {"error": "numpy not installed"}
+    n = max(10, args.tokens)
+    addrs = ([("PUMP", f"P{i:043d}") for i in range(n)] + [("SOL", f"S{i:043d}") for i in range(n // 3)]
+             + [("BSC", f"B{i:043d}") for i in range(n // 3)])
+    rings = {mode: (main.VolumeRing(f"np_{mode}", w, mode), without_numpy(main, main.VolumeRing, f"py_{mode}", w, mode))
+             for mode, w in (("pump", main.pump_vol_ring.window), ("dex", main.dex_vol_ring.window))}
+    spikes = {"rows": 0, "mismatches": 0}
+    classify = {"rows": 0, "mismatches": 0}
+    live = {"alerts": 0, "upgrades": 0, "by_level": {"min": 0, "medium": 0, "max": 0}}
+    states = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        history = main.HistoryStore(tmp)
+        ts = 1_000_000.0
+        for _ in range(cycles):
+            ts += 10
+            snaps = random_snaps(main, addrs, n)
+            for mode, batch in (("pump", [s for s in snaps if s.chain == "PUMP"]),
+                                ("dex", [s for s in snaps if s.chain != "PUMP"])):
+                fast, slow = rings[mode]
+                keys, vols = [s.addr for s in batch], [s.vol for s in batch]
+                spike = fast.push(keys, vols)
+                spikes["rows"] += len(batch)
+                spikes["mismatches"] += sum(a != b for a, b in zip(spike, without_numpy(main, slow.push, keys, vols)))
+                buys = [random.random() < 0.2 for _ in batch]
+                levels = main.classify_batch(batch, spike, buys)
+                classify["rows"] += len(batch)
+                classify["mismatches"] += sum(
+                    a != b for a, b in zip(levels, without_numpy(main, main.classify_batch, batch, spike, buys)))
+                # history holds no large buys, so the replay runs without them
+                history.record(batch, ts=ts)
+                for snap, level in zip(batch, main.classify_batch(batch, spike, [False] * len(batch))):
+                    decision = level and states.setdefault(snap.addr, main.TokenAlertState()).decide(level, False, ts)
+                    if decision:
+                        live["alerts"] += 1
+                        live["upgrades"] += decision[0] == "upgrade"
+                        live["by_level"][decision[1]] += 1
+        history.flush_sync()
+        replay = main.backtest(tmp, {"current": {}})["sets"]["current"]
+    replay = {k: replay[k] for k in ("alerts", "upgrades", "by_level")}
+    return {"spikes": spikes, "classify": classify, "live": live, "backtest": replay,
+            "ok": not spikes["mismatches"] and not classify["mismatches"] and live == replay}
+
+async def scenario(name, base, args):
+    import main
+    if name == "equiv":
+        cpu0, t0 = time.process_time(), time.monotonic()
+        result = check_equivalence(main, args)
+        return {"scenario": name, "wall_s": round(time.monotonic() - t0, 3),
+                "cpu_s": round(time.process_time() - cpu0, 3), **result}
+    seed_users(main, args.users)
+    app = main.build_application()
+    await app.initialize()
+    main.delivery_queue.start(app)
+    async with aiohttp.ClientSession() as sess:
+        await sess.post(base + "/_reset")
+        extra = {}
+        cpu0, t0 = time.process_time(), time.monotonic()
+        if name == "pump":
+            await run_for(main.pump_scanner(app), args.duration)
+        elif name == "dex":
+            main.DEX_CYCLE = args.dex_cycle
+            await run_for(main.dex_scanner(app), args.duration)
+        elif name == "ws":
+            main.PUMP_WS_URL = base.replace("http", "ws", 1) + "/ws"
+            await run_for(asyncio.gather(main.pump_ws_ingest(app), main.pump_scanner(app)), args.duration)
+            events = {k[0]: int(v) for k, v in main.PUMP_WS_EVENTS.values.items()}
+            extra["ws_events"] = events
+            extra["ws_connects"] = int(sum(main.PUMP_WS_CONNECTS.values.values()))
+            row = main.PUMP_WS_DETECT.values.get((), [0, 0.0])
+            extra["ws_alerts"] = sum(row[:-1])
+            extra["ws_detect_mean_s"] = round(row[-1] / sum(row[:-1]), 3) if sum(row[:-1]) else None
+        elif name == "broadcast":
+            alert_times = []
+            for i in range(args.alerts):
+                snap = main.TokenSnapshot("PUMP", rand_addr(), f"B{i}", 20_000, 60_000, 4_000)
+                await sess.post(base + "/_born", json={"addr": snap.addr})
+                t1 = time.monotonic()
+                await main.deliver_alert(app, "PUMP", "medium", main.format_alert(snap, "medium"), consume_trial=False)
+                await main.delivery_queue.join()
+                alert_times.append(time.monotonic() - t1)
+            extra["alert_fanout_s"] = percentiles(alert_times)
+            extra["recipients_per_alert"] = len(main.routing.recipients("PUMP", "medium"))
+        else:
+            extra.update(await post_updates(main, app, sess, base, args))
+        wall = time.monotonic() - t0
+        cpu = time.process_time() - cpu0
+        async with sess.get(base + "/_stats") as r:
+            upstream = await r.json()
+    await app.shutdown()
+    await main.http.close()
+    main.store.close()
+    return {
+        "scenario": name,
+        "wall_s": round(wall, 3),
+        "cpu_s": round(cpu, 3),
+        "cpu_util": round(cpu / wall, 3) if wall else None,
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "messages": upstream["messages"],
+        "messages_per_s": round(upstream["messages"] / wall, 2) if wall else None,
+        "e2e_latency_s": upstream["e2e_latency_s"],
+        "telegram_429": upstream["telegram_429"],
+        "injected_errors": upstream["injected_errors"],
+        "upstream_requests": upstream["requests"],
+        **({"ws": upstream["ws"], "launch_to_alert_s": upstream["launch_to_alert_s"]} if name == "ws" else {}),
+        **extra,
+    }
+
+def run_scenario(name, base, args, conn):
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ.update(bot_env(base, os.path.join(tmp, "bench.db"), args))
+        if not args.verbose:
+            logging.disable(logging.INFO)
+        random.seed(args.seed)
+        try:
+            conn.send(asyncio.run(scenario(name, base, args)))
+        except Exception as e:
+            conn.send({"scenario": name, "error": repr(e)})
+
+# --------------------------------------------------------------------------- #
+#                                   MAIN                                    #
+# --------------------------------------------------------------------------- #
+def parse_args(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--scenario", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    ap.add_argument("--users", type=int, default=10_000)
+    ap.add_argument("--tokens", type=int, default=500, help="tokens per upstream response")
+    ap.add_argument("--fresh", type=float, default=0.2, help="share of new tokens per response")
+    ap.add_argument("--alerts", type=int, default=5, help="alerts in the broadcast scenario")
+    ap.add_argument("--updates", type=int, default=200, help="/start updates in the webhook scenario")
+    ap.add_argument("--duration", type=float, default=20.0, help="seconds per scanner scenario")
+    ap.add_argument("--dex-cycle", type=float, default=5.0, help="DEX cycle sleep during the bench")
+    ap.add_argument("--ws-rate", type=float, default=20.0, help="mock websocket messages/s")
+    ap.add_argument("--ws-drop-after", type=int, default=50, help="messages per websocket connection")
+    ap.add_argument("--ws-gap", type=int, default=10, help="launches made during each websocket drop")
+    ap.add_argument("--ws-dup", type=float, default=0.1, help="share of repeated websocket messages")
+    ap.add_argument("--latency", type=float, default=0.05, help="mean fake upstream latency (s)")
+    ap.add_argument("--error-rate", type=float, default=0.0)
+    ap.add_argument("--rate-limit", type=int, default=0, help="fake Telegram msg/s before 429 (0 = none)")
+    ap.add_argument("--send-rate", type=float, default=1000.0, help="bot-side SEND_RATE")
+    ap.add_argument("--port", type=int, default=18080)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--out", default="bench_results.json")
+    ap.add_argument("--verbose", action="store_true")
+    return ap.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    ctx = multiprocessing.get_context("spawn")
+    fakes = ctx.Process(target=serve_fakes, args=(args.port, args), daemon=True)
+    fakes.start()
+    base = f"http://127.0.0.1:{args.port}"
+    time.sleep(1.0)
+
+    results = []
+    try:
+        for name in args.scenario:
+            recv, send = ctx.Pipe(duplex=False)
+            proc = ctx.Process(target=run_scenario, args=(name, base, args, send))
+            proc.start()
+            result = recv.recv()
+            proc.join()
+            print(json.dumps(result), file=sys.stderr)
+            results.append(result)
+    finally:
+        fakes.terminate()
+
+    report = {
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("out", "verbose")},
+        "results": results,
+    }
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"wrote {args.out}")
+
+if __name__ == "__main__":
+    main()
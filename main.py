@@ -1,22 +1,51 @@
 #!/usr/bin/env python3
 import os
+import queue
+import argparse
 import asyncio
 import json
 import time
 import logging
+import logging.handlers
+import atexit
+import sqlite3
+import sys
+import heapq
+import base64
+import hashlib
+import hmac
+import secrets
+import re
+import bisect
+import multiprocessing
+from array import array
 from collections import defaultdict, deque
 from datetime import datetime, timedelta
 from pathlib import Path
+from types import SimpleNamespace
+from urllib.parse import urlsplit
 
 import aiohttp
-import requests
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from aiohttp import web
+try:
+    import orjson  # optional, faster decoding of upstream payloads
+except ImportError:
+    orjson = None
+try:
+    import numpy as np  # optional, vectorised classification
+except ImportError:
+    np = None
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application,
     CommandHandler,
     ContextTypes,
     CallbackQueryHandler,
+    ChatJoinRequestHandler,
+    ChatMemberHandler,
 )
+from telegram.error import BadRequest, RetryAfter
+from telegram.request import HTTPXRequest
 from telegram.helpers import escape_markdown
 # NEW: Official Moralis Pump.fun Endpoints (2025)
 
@@ -24,98 +53,654 @@ from telegram.helpers import escape_markdown
 #                               SAFE SEND                                    #
 # --------------------------------------------------------------------------- #
 async def safe_send(app, chat_id, text):
+    """
+    Send a RenderedAlert or a MarkdownV2 string. Only a markup rejection is
+    retried as plain text, and a rejected alert stays plain for the rest of
+    its recipients. RetryAfter is re-raised so the dispatcher can back off
+    and retry.
+    """
+    if isinstance(text, RenderedAlert):
+        markdown, plain = text.markdown, text.plain
+    else:
+        markdown = plain = text
+    if markdown is not None:
+        try:
+            await app.bot.send_message(
+                chat_id=chat_id,
+                text=markdown,
+                parse_mode="MarkdownV2",
+                disable_web_page_preview=True
+            )
+            return True
+        except RetryAfter:
+            raise
+        except BadRequest as e:
+            if "parse" not in str(e).lower():
+                log.debug("Send failed (chat %s): %s", chat_id, e)
+                return False
+            SEND_FALLBACKS.inc()
+            log.warning("MarkdownV2 rejected, sending plain: %s", e)
+            if isinstance(text, RenderedAlert):
+                text.markdown = None
+        except Exception as e:
+            log.debug("Send failed (chat %s): %s", chat_id, e)
+            return False
     try:
-        await app.bot.send_message(
-            chat_id=chat_id,
-            text=text,
-            parse_mode="MarkdownV2",
-            disable_web_page_preview=True
-        )
+        await app.bot.send_message(chat_id=chat_id, text=plain, disable_web_page_preview=True)
+        return True
+    except RetryAfter:
+        raise
     except Exception as e:
-        log.warning(f"Send failed (chat {chat_id}): {e}")
-        try:
-            await app.bot.send_message(chat_id=chat_id, text=text, disable_web_page_preview=True)
-        except:
-            pass
+        log.debug("Plain send failed (chat %s): %s", chat_id, e)
+        return False
 
 # --------------------------------------------------------------------------- #
 #                               CONFIGURATION                               #
 # --------------------------------------------------------------------------- #
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-if not BOT_TOKEN:
-    raise RuntimeError("BOT_TOKEN is required")
 
 ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))
 FREE_ALERTS = 3
 PRICE_USDT = 19.99
 WALLETS = {"BSC": os.getenv("WALLET_BSC", "0xa11351776d6f483418b73c8e40bc706c93e8b1e1")}
 
-GOPLUS_API = "https://api.gopluslabs.io/api/v1/token_security/{chain_id}?contract_addresses={addrs}"
-SOLANA_RPC = "https://api.mainnet-beta.solana.com"
-BSCSCAN_API = "https://api.bscscan.com/api"
+# upstream endpoints are overridable so bench.py (or a proxy) can stand in
+MORALIS_BASE_URL = os.getenv("MORALIS_BASE_URL", "https://solana-gateway.moralis.io")
+BIRDEYE_BASE_URL = os.getenv("BIRDEYE_BASE_URL", "https://public-api.birdeye.so")
+GOPLUS_BASE_URL = os.getenv("GOPLUS_BASE_URL", "https://api.gopluslabs.io")
+GOPLUS_API = GOPLUS_BASE_URL + "/api/v1/token_security/{chain_id}?contract_addresses={addrs}"
+SOLANA_RPC = os.getenv("SOLANA_RPC", "https://api.mainnet-beta.solana.com")
+BSCSCAN_API = os.getenv("BSCSCAN_API", "https://api.bscscan.com/api")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org/bot")
 
 # RAILWAY
-DATA_FILE = Path("/tmp/data.json")
+DB_FILE = Path(os.getenv("DB_FILE", "/tmp/data.db"))
+DATA_FILE = Path("/tmp/data.json")  # legacy JSON dump, imported once into DB_FILE
 SAVE_INTERVAL = 30
+SWEEP_INTERVAL = 60
+HISTORY_DIR = os.getenv("HISTORY_DIR")  # enables the columnar snapshot history (backtests)
+
+# (ttl seconds, max entries) for the in-memory stores
+SEEN_LIMITS = (3600, 100_000)
+TOKEN_STATE_LIMITS = (2 * 86400, 50_000)
+VOL_HIST_LIMITS = (3600, 20_000)
+GOPLUS_CACHE_LIMITS = (3600, 20_000)
+
 MORALIS_API_KEY = os.getenv("MORALIS_API_KEY")
-if not MORALIS_API_KEY:
-    raise RuntimeError("MORALIS_API_KEY is required")
-MORALIS_NEW_URL = "https://solana-gateway.moralis.io/token/mainnet/exchange/pumpfun/new"
-MORALIS_TRENDING_URL = "https://solana-gateway.moralis.io/token/mainnet/exchange/pumpfun/trending"
+MORALIS_NEW_URL = MORALIS_BASE_URL + "/token/mainnet/exchange/pumpfun/new"
+MORALIS_TRENDING_URL = MORALIS_BASE_URL + "/token/mainnet/exchange/pumpfun/trending"
+PUMP_WS_URL = os.getenv("PUMP_WS_URL")  # e.g. wss://api.mainnet-beta.solana.com; enables realtime mode
+PUMP_PROGRAM_ID = "6EF8rrecthR5Dkzon8Nwu78hRvfCKubJ14M5uBEwF6P"
+MORALIS_GRADUATED_URL = MORALIS_BASE_URL + "/token/mainnet/exchange/pumpfun/graduated"
+BIRDEYE_NEW_PAIRS_URL = BIRDEYE_BASE_URL + "/defi/v2.0/new_pairs"
+
+PUMP_FEEDS = {
+    "NEW": (MORALIS_NEW_URL, {"limit": 50}),
+    "GRADUATED": (MORALIS_GRADUATED_URL, {"limit": 50, "order": "volume.desc"}),
+}
+PUMP_POLL_MIN = 3
+PUMP_POLL_MAX = 30
+PUMP_POLL_TARGET_FRESH = 10   # aim for ~10 unseen mints per poll
+PUMP_STATS_EVERY = 30         # polls between endpoint stat summaries
+
+def parse_alert_channels(spec):
+    # "PUMP:max=-1001234567890,SOL:medium=-1009876543210" -> {(chain, level): chat_id}
+    channels = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        key, chat_id = item.split("=", 1)
+        chain, level = key.split(":", 1)
+        channels[(chain.strip(), level.strip())] = int(chat_id)
+    return channels
+
+# optional channel tier: each alert is posted once to the channel of its
+# (chain, level); premium members of that channel get no DM for it
+ALERT_CHANNELS = parse_alert_channels(os.getenv("ALERT_CHANNELS", ""))
+
+# "single": everything on one event loop; "split": scanner process + bot
+# process + DELIVERY_WORKERS sender processes sharded by chat id
+RUN_MODE = os.getenv("RUN_MODE", "single")
+DELIVERY_WORKERS = int(os.getenv("DELIVERY_WORKERS", "2"))
+BROKER_QUEUE_SIZE = 1000
+
+# Prometheus text endpoint; 0 disables it. In split mode the scanner and the
+# delivery workers serve on the following ports (+1, +2, ...).
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+LOOP_LAG_INTERVAL = 0.5
+
+# Webhook mode: set WEBHOOK_URL to the public https URL Telegram should POST
+# updates to (usually a TLS proxy in front of WEBHOOK_PORT). The same server
+# answers /healthz, /readyz and /metrics. Unset = long polling.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+# local route; defaults to the path of WEBHOOK_URL (override if a proxy rewrites it)
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH") or (urlsplit(WEBHOOK_URL).path or "/" if WEBHOOK_URL else "/telegram")
+# echoed by Telegram in X-Telegram-Bot-Api-Secret-Token; a random one per
+# start is fine since set_webhook is called on every start
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
 
 # --------------------------------------------------------------------------- #
 #                                 LOGGING                                   #
 # --------------------------------------------------------------------------- #
-logging.basicConfig(level=logging.INFO)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")               # "text" or "json"
+LOG_TOKEN_SAMPLE = int(os.getenv("LOG_TOKEN_SAMPLE", "5"))  # per-token DEBUG lines per poll
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if record.processName != "MainProcess":
+            entry["process"] = record.processName
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands the record over as-is: message formatting happens on the listener
+    thread, so the event loop only pays for a queue put. Log arguments must
+    therefore not be mutated after the call (we only pass scalars).
+    """
+    def prepare(self, record):
+        return record
+
+log_listener = None
+
+def setup_logging():
+    """
+    Route every record through a queue to a background writer thread.
+    Called again in forked workers, which do not inherit the thread.
+    """
+    global log_listener
+    handler = logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(levelname)s:%(name)s:%(message)s"))
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers[:] = [DeferredQueueHandler(log_queue)]
+    root.setLevel(LOG_LEVEL)
+    # httpx logs every Telegram request at INFO
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    log_listener = logging.handlers.QueueListener(log_queue, handler)
+    log_listener.start()
+
+def stop_logging():
+    if log_listener is not None:
+        log_listener.stop()
+
+setup_logging()
+atexit.register(stop_logging)
 log = logging.getLogger("onion")
 
+# --------------------------------------------------------------------------- #
+#                                 METRICS                                   #
+# --------------------------------------------------------------------------- #
+class Metric:
+    """
+    Minimal Prometheus metric: samples keyed by label-value tuple, rendered
+    in the text exposition format on scrape. Updates are a dict operation,
+    so instrumenting hot paths costs next to nothing.
+    """
+    kind = "untyped"
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.values = defaultdict(float)
+        registry.append(self)
+
+    def _labels(self, values, extra=""):
+        pairs = [f'{k}="{v}"' for k, v in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self):
+        for values, v in self.values.items():
+            yield f"{self.name}{self._labels(values)} {v}"
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, n=1):
+        self.values[labels] += n
+
+class Gauge(Metric):
+    """set() for pushed values, or fn() -> {label tuple: value} read on scrape."""
+    kind = "gauge"
+
+    def __init__(self, name, doc, labels=(), fn=None):
+        super().__init__(name, doc, labels)
+        self.fn = fn
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+    def samples(self):
+        if self.fn is not None:
+            self.values = defaultdict(float, self.fn())
+        yield from super().samples()
+
+class Histogram(Metric):
+    kind = "histogram"
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, name, doc, labels=(), buckets=BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = buckets
+        self.values = {}  # labels -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, value, *labels):
+        row = self.values.get(labels)
+        if row is None:
+            row = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        row[bisect.bisect_left(self.buckets, value)] += 1
+        row[-1] += value
+
+    def samples(self):
+        for values, row in self.values.items():
+            total = 0
+            for bound, n in zip(self.buckets + ("+Inf",), row):
+                total += n
+                le = f'le="{bound}"'
+                yield f"{self.name}_bucket{self._labels(values, le)} {total}"
+            yield f"{self.name}_sum{self._labels(values)} {row[-1]}"
+            yield f"{self.name}_count{self._labels(values)} {total}"
+
+registry = []
+
+def render_metrics():
+    return "\n".join(m.render() for m in registry) + "\n"
+
+UPSTREAM_REQUESTS = Counter("onion_upstream_requests_total", "Upstream HTTP requests", ("endpoint", "status"))
+UPSTREAM_LATENCY = Histogram("onion_upstream_latency_seconds", "Upstream HTTP latency", ("endpoint",))
+TOKENS_SCANNED = Counter("onion_tokens_scanned_total", "Tokens classified", ("chain",))
+ALERTS = Counter("onion_alerts_total", "Alerts emitted", ("chain", "level"))
+SEND_LATENCY = Histogram("onion_send_latency_seconds", "Single Telegram send, including rate-limit waits")
+SEND_FAILURES = Counter("onion_send_failures_total", "Sends that were not delivered")
+SEND_FALLBACKS = Counter("onion_send_fallbacks_total", "MarkdownV2 sends retried as plain text")
+DELIVERY_WAIT = Histogram("onion_delivery_wait_seconds", "Queue wait per send, by priority class", ("class",))
+DELIVERY_DROPS = Counter("onion_delivery_drops_total", "Queued sends dropped", ("reason",))
+ALERT_FANOUT = Histogram("onion_alert_fanout_seconds", "Enqueue to last finished send of one alert", ("level",))
+DELIVERY_COALESCED = Counter("onion_delivery_coalesced_total", "Min alerts merged into an already queued send")
+PUMP_WS_EVENTS = Counter("onion_pump_ws_events_total", "pump.fun stream events by kind", ("result",))
+PUMP_WS_DETECT = Histogram("onion_pump_ws_detect_seconds", "Launch to first alert from the stream")
+PUMP_WS_CONNECTS = Counter("onion_pump_ws_connects_total", "pump.fun websocket subscriptions")
+SAVE_SECONDS = Histogram("onion_save_seconds", "Duration of one store commit")
+LOOP_LAG = Histogram("onion_event_loop_lag_seconds", "Event-loop scheduling delay")
+WEBHOOK_UPDATES = Counter("onion_webhook_requests_total", "Webhook requests by outcome", ("status",))
+
+async def monitor_loop_lag():
+    loop = asyncio.get_running_loop()
+    while True:
+        t0 = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        LOOP_LAG.observe(max(0.0, loop.time() - t0 - LOOP_LAG_INTERVAL))
+
 # --------------------------------------------------------------------------- #
 #                               PERSISTENCE                                 #
 # --------------------------------------------------------------------------- #
+TABLES = ("tracker", "users", "seen", "last_alerted", "token_state", "pending_payments")
+
+class DirtyDict(dict):
+    """
+    dict that remembers which keys were set or deleted since the last save.
+    In-place edits of a stored value (users[uid]["free"] -= 1) are invisible
+    to it, so those call sites must follow up with touch(key).
+    """
+    tracked = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dirty = set()
+        self.deleted = set()
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        if self.tracked:
+            self.dirty.add(key)
+            self.deleted.discard(key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        if self.tracked:
+            self.dirty.discard(key)
+            self.deleted.add(key)
+
+    def pop(self, key, *default):
+        if key not in self:
+            return super().pop(key, *default)
+        value = dict.__getitem__(self, key)
+        del self[key]
+        return value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for k, v in dict(*args, **kwargs).items():
+            self[k] = v
+
+    def clear(self):
+        for key in list(self):
+            del self[key]
+
+    def touch(self, key):
+        if key in self and self.tracked:
+            self.dirty.add(key)
+
+    def load_item(self, key, value):
+        dict.__setitem__(self, key, value)
+
+expiring_maps = []
+
+class ExpiringMap(DirtyDict):
+    """
+    DirtyDict whose entries expire `ttl` seconds after their last write (or
+    touch) and which never holds more than `maxlen` keys; the least recently
+    written key is evicted first. Expired keys are removed by sweep(). With a
+    `factory` it behaves like a defaultdict. Only persisted maps track changes.
+    """
+    def __init__(self, name, ttl, maxlen, factory=None, persist=False, on_evict=None):
+        super().__init__()
+        self.name = name
+        self.ttl = ttl
+        self.maxlen = maxlen
+        self.factory = factory
+        self.on_evict = on_evict
+        self.tracked = persist
+        self.expires = {}  # key -> expiry timestamp, in write order
+        self.evicted = 0
+        self.expired = 0
+        expiring_maps.append(self)
+
+    def _stamp(self, key, ttl=None):
+        self.expires.pop(key, None)
+        self.expires[key] = time.time() + (ttl or self.ttl)
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def set(self, key, value, ttl=None):
+        super().__setitem__(key, value)
+        self._stamp(key, ttl)
+        while len(self.expires) > self.maxlen:
+            del self[next(iter(self.expires))]
+            self.evicted += 1
+
+    def __delitem__(self, key):
+        value = dict.__getitem__(self, key)
+        super().__delitem__(key)
+        self.expires.pop(key, None)
+        if self.on_evict is not None:
+            self.on_evict(key, value)
+
+    def __missing__(self, key):
+        if self.factory is None:
+            raise KeyError(key)
+        value = self[key] = self.factory()
+        return value
+
+    def get_fresh(self, key, default=None):
+        exp = self.expires.get(key)
+        if exp is None or exp <= time.time():
+            return default
+        return dict.__getitem__(self, key)
+
+    def touch(self, key):
+        if key in self:
+            self._stamp(key)
+            super().touch(key)
+
+    def load_item(self, key, value):
+        self.set(key, value)
+        self.dirty.discard(key)
+
+    def sweep(self, now=None):
+        now = now or time.time()
+        dead = [k for k, exp in self.expires.items() if exp <= now]
+        for k in dead:
+            del self[k]
+        self.expired += len(dead)
+        return len(dead)
+
+    def stats(self):
+        return {
+            "size": len(self),
+            "bytes": sys.getsizeof(self) + sys.getsizeof(self.expires),
+            "evicted": self.evicted,
+            "expired": self.expired,
+        }
+
+async def sweep_stores():
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL)
+        for m in expiring_maps:
+            if m.sweep():
+                log.info(f"Store {m.name}: {m.stats()}")
+
+class Store:
+    """
+    SQLite (WAL) key/value store: one row per record, so a save only writes the
+    records that changed and each save is a single atomic transaction.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+        self.pid = None
+
+    def _db(self):
+        if self.pid != os.getpid():
+            # never reuse a connection inherited across fork()
+            self.conn = None
+        if self.conn is None:
+            self.pid = os.getpid()
+            self.conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS kv ("
+                " tbl TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,"
+                " PRIMARY KEY (tbl, key)) WITHOUT ROWID"
+            )
+        return self.conn
+
+    def rows(self):
+        yield from self._db().execute("SELECT tbl, key, value FROM kv")
+
+    def commit(self, upserts, deletes):
+        db = self._db()
+        with db:
+            if upserts:
+                db.executemany(
+                    "INSERT INTO kv (tbl, key, value) VALUES (?, ?, ?) "
+                    "ON CONFLICT (tbl, key) DO UPDATE SET value = excluded.value",
+                    upserts,
+                )
+            if deletes:
+                db.executemany("DELETE FROM kv WHERE tbl = ? AND key = ?", deletes)
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+store = Store(DB_FILE)
+
+def _decode_key(tbl, key):
+    # Telegram user ids are ints at runtime; JSON/SQLite hand them back as str
+    if tbl == "users" and key.lstrip("-").isdigit():
+        return int(key)
+    return key
+
+LEVEL_BITS = {"min": 1, "medium": 2, "max": 4, "large_buy": 8, "upgrade": 16}
+BASE_LEVELS = ("min", "medium", "max")
+ALERT_COOLDOWN = 900   # seconds before a token at max may fire another large_buy
+
+class TokenAlertState:
+    """
+    Alert history of one token, shared by every scanner: a bit per level
+    sent plus first/last alert time. Stored as [flags, first, last].
+    """
+    __slots__ = ("flags", "first", "last")
+
+    def __init__(self, flags=0, first=0.0, last=0.0):
+        self.flags = flags
+        self.first = first
+        self.last = last
+
+    def to_json(self):
+        return [self.flags, round(self.first, 1), round(self.last, 1)]
+
+    @classmethod
+    def from_json(cls, value):
+        if isinstance(value, dict):
+            # pre-bitmask records: {"sent_levels": [...]}
+            flags = 0
+            for level in value.get("sent_levels") or ():
+                flags |= LEVEL_BITS.get(level, 0)
+            return cls(flags)
+        return cls(*value)
+
+    def top_rank(self):
+        for rank in range(len(BASE_LEVELS) - 1, -1, -1):
+            if self.flags & LEVEL_BITS[BASE_LEVELS[rank]]:
+                return rank
+        return -1
+
+    def exhausted(self, now):
+        """True when no classification could produce an alert right now."""
+        return bool(self.flags & LEVEL_BITS["max"]) and now - self.last < ALERT_COOLDOWN
+
+    def decide(self, level, large_buy, now):
+        """
+        (alert, route level) for a classified level, or None. The first alert
+        goes out as its level; a higher level later goes out as "upgrade"; a
+        large buy on a token already at max goes out as "large_buy", at most
+        once per ALERT_COOLDOWN. Escalations are routed to the level reached.
+        """
+        rank = BASE_LEVELS.index(level)
+        top = self.top_rank()
+        if rank > top:
+            alert = level if top < 0 else "upgrade"
+        elif level == "max" and large_buy and now - self.last >= ALERT_COOLDOWN:
+            alert = "large_buy"
+        else:
+            return None
+        self.flags |= LEVEL_BITS[level] | LEVEL_BITS[alert]
+        self.first = self.first or now
+        self.last = now
+        return alert, level
+
+VALUE_DECODERS = {"token_state": TokenAlertState.from_json}
+
+def _decode_value(tbl, value):
+    decode = VALUE_DECODERS.get(tbl)
+    return decode(value) if decode else value
+
+def _encode_value(obj):
+    if hasattr(obj, "to_json"):
+        return obj.to_json()
+    raise TypeError(f"{type(obj).__name__} is not JSON serializable")
+
 def load_data():
-    if DATA_FILE.is_file():
-        try:
+    """
+    Every table, decoded at startup. Rows stream from SQLite one record at
+    a time, so no whole-file blob is parsed, but loading is not lazy: the
+    routing index needs every user up front and the expiring maps need
+    every key to sweep and cap.
+    """
+    data = {tbl: DirtyDict() for tbl in TABLES}
+    data["seen"] = ExpiringMap("seen", *SEEN_LIMITS, persist=True)
+    data["token_state"] = ExpiringMap("token_state", *TOKEN_STATE_LIMITS, persist=True)
+    try:
+        loaded = 0
+        for tbl, key, value in store.rows():
+            if tbl in data:
+                data[tbl].load_item(_decode_key(tbl, key), _decode_value(tbl, json.loads(value)))
+                loaded += 1
+        if not loaded and DATA_FILE.is_file():
             raw = json.loads(DATA_FILE.read_text())
-            users_raw = raw.get("users", {})
-            for u in users_raw.values():
-                u.setdefault("test_sent", False)
-                u.setdefault("chat_id", None)
-                u.setdefault("filters", {
-                    "levels": ["min", "medium", "max"],
-                    "chains": ["SOL", "BSC", "PUMP"],
-                    "premium_only": False
-                })
-            return {
-                "tracker": raw.get("tracker", {}),
-                "users": users_raw,
-                "seen": {str(k): v for k, v in raw.get("seen", {}).items()},
-                "last_alerted": {str(k): v for k, v in raw.get("last_alerted", {}).items()},
-                "token_state": raw.get("token_state", {}),
-            }
-        except Exception as e:
-            log.error(f"Load error: {e}")
-    return {
-        "tracker": {},
-        "users": {},
-        "seen": {},
-        "last_alerted": {},
-        "token_state": {},
-    }
+            for tbl in TABLES:
+                for k, v in raw.get(tbl, {}).items():
+                    data[tbl][_decode_key(tbl, str(k))] = _decode_value(tbl, v)
+            log.info(f"Imported legacy {DATA_FILE} into {DB_FILE}")
+    except Exception as e:
+        log.error(f"Load error: {e}")
+    for u in data["users"].values():
+        u.setdefault("test_sent", False)
+        u.setdefault("chat_id", None)
+        u.setdefault("filters", {
+            "levels": ["min", "medium", "max"],
+            "chains": ["SOL", "BSC", "PUMP"],
+            "premium_only": False
+        })
+    return data
+
+def collect_changes(data):
+    # Synchronous on purpose: no await in here, so the batch is a consistent
+    # snapshot of every table even while scanners keep running.
+    upserts, deletes = [], []
+    for tbl in TABLES:
+        table = data[tbl]
+        for k in table.dirty:
+            if k is None or k not in table:
+                continue
+            try:
+                upserts.append((tbl, str(k), json.dumps(table[k], separators=(",", ":"), default=_encode_value)))
+            except (TypeError, ValueError) as e:
+                log.warning(f"Save skipped {tbl}/{k}: {e}")
+        deletes.extend((tbl, str(k)) for k in table.deleted if k is not None)
+        table.dirty, table.deleted = set(), set()
+    return upserts, deletes
+
+def _requeue_changes(data, upserts, deletes):
+    # keys touched again while the commit ran are already queued their new way
+    for tbl, key, _ in upserts:
+        k = _decode_key(tbl, key)
+        if k in data[tbl]:
+            data[tbl].dirty.add(k)
+    for tbl, key in deletes:
+        k = _decode_key(tbl, key)
+        if k not in data[tbl]:
+            data[tbl].deleted.add(k)
+
+def timed_commit(upserts, deletes):
+    t0 = time.monotonic()
+    store.commit(upserts, deletes)
+    SAVE_SECONDS.observe(time.monotonic() - t0)
 
 def save_data(data):
+    upserts, deletes = collect_changes(data)
     try:
-        clean_seen = {str(k): v for k, v in data["seen"].items() if k is not None}
-        clean_last = {str(k): v for k, v in data["last_alerted"].items() if k is not None}
-        clean_token_state = {str(k): v for k, v in data["token_state"].items() if k is not None}
-
-        DATA_FILE.write_text(json.dumps({
-            "tracker": data["tracker"],
-            "users": data["users"],
-            "seen": clean_seen,
-            "last_alerted": clean_last,
-            "token_state": clean_token_state,
-        }, indent=2))
+        timed_commit(upserts, deletes)
     except Exception as e:
+        _requeue_changes(data, upserts, deletes)
+        log.error(f"Save error: {e}")
+
+async def save_data_async(data):
+    upserts, deletes = collect_changes(data)
+    if not upserts and not deletes:
+        return
+    try:
+        await asyncio.to_thread(timed_commit, upserts, deletes)
+    except Exception as e:
+        _requeue_changes(data, upserts, deletes)
         log.error(f"Save error: {e}")
 
 data = load_data()
@@ -124,11 +709,14 @@ users = data["users"]
 seen = data["seen"]
 last_alerted = data["last_alerted"]
 token_state = data["token_state"]
+pending_payments = data["pending_payments"]
 
-vol_hist = defaultdict(lambda: deque(maxlen=5))
-goplus_cache = {}
+goplus_cache = ExpiringMap("goplus_cache", *GOPLUS_CACHE_LIMITS)
 save_lock = asyncio.Lock()
 
+Gauge("onion_store_entries", "Entries per in-memory store", ("store",),
+      fn=lambda: {(name, ): len(table) for name, table in {**data, **{m.name: m for m in expiring_maps}}.items()})
+
 # --------------------------------------------------------------------------- #
 #                               AUTO SAVE                                   #
 # --------------------------------------------------------------------------- #
@@ -136,7 +724,539 @@ async def auto_save():
     while True:
         await asyncio.sleep(SAVE_INTERVAL)
         async with save_lock:
-            save_data(data)
+            await save_data_async(data)
+        if history is not None:
+            await history.flush()
+
+# --------------------------------------------------------------------------- #
+#                               DELIVERY                                    #
+# --------------------------------------------------------------------------- #
+GLOBAL_RATE = float(os.getenv("SEND_RATE", "30"))  # Telegram: ~30 msg/s per bot (more with paid broadcasts)
+PER_CHAT_RATE = 1       # Telegram: ~1 msg/s per chat
+GROUP_RATE = 20 / 60    # Telegram: ~20 msg/min per group or channel
+SEND_CONCURRENCY = 25
+SEND_RETRIES = 3
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+    def try_acquire(self):
+        """Take a token if one is free and return 0.0, else the seconds until one is."""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class Dispatcher:
+    """
+    Rate-limited sender. Sends are bounded by a semaphore and paced by a
+    global token bucket plus one bucket per chat; a RetryAfter from Telegram
+    pauses every sender for the requested time before the message is retried.
+    """
+    def __init__(self, concurrency=SEND_CONCURRENCY, rate=GLOBAL_RATE, per_chat=PER_CHAT_RATE):
+        self.sem = asyncio.Semaphore(concurrency)
+        self.global_bucket = TokenBucket(rate)
+        self.per_chat = per_chat
+        self.chat_buckets = {}
+        self.paused_until = 0.0
+
+    def _chat_bucket(self, chat_id):
+        b = self.chat_buckets.get(chat_id)
+        if b is None:
+            if len(self.chat_buckets) > 10000:
+                self.chat_buckets = {k: v for k, v in self.chat_buckets.items() if not v.full()}
+            # groups and channels have negative ids and a much lower limit
+            b = self.chat_buckets[chat_id] = (
+                TokenBucket(self.per_chat) if chat_id > 0 else TokenBucket(GROUP_RATE, capacity=3)
+            )
+        return b
+
+    def claim(self, chat_id):
+        """Reserve the chat's next send slot: 0.0 if taken, else seconds until one is free."""
+        return self._chat_bucket(chat_id).try_acquire()
+
+    async def send(self, app, chat_id, text, claimed=False):
+        # claimed: the caller already holds this chat's slot (see claim())
+        async with self.sem:
+            for _ in range(SEND_RETRIES):
+                delay = self.paused_until - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if claimed:
+                    claimed = False
+                else:
+                    await self._chat_bucket(chat_id).acquire()
+                await self.global_bucket.acquire()
+                try:
+                    return await safe_send(app, chat_id, text)
+                except RetryAfter as e:
+                    wait = e.retry_after
+                    if isinstance(wait, timedelta):
+                        wait = wait.total_seconds()
+                    log.warning("RetryAfter %.0fs (chat %s)", wait, chat_id)
+                    self.paused_until = max(self.paused_until, time.monotonic() + wait)
+        return False
+
+LEVEL_PRIORITY = {"max": 0, "medium": 1, "min": 2}
+ALERT_DEADLINES = {"max": 300, "medium": 120, "min": 60}  # seconds; later is dropped
+DELIVERY_QUEUE_MAX = 20_000
+COALESCE_MAX = 5          # min alerts merged into one message per chat
+
+def _percentile(sorted_vals, q):
+    if not sorted_vals:
+        return 0.0
+    idx = min(len(sorted_vals) - 1, int(round(q * (len(sorted_vals) - 1))))
+    return sorted_vals[idx]
+
+class AlertFanout:
+    """Outstanding sends of one pushed alert; reports its fan-out when the last one finishes."""
+    __slots__ = ("level", "started", "pending", "total", "latencies")
+
+    def __init__(self, level, n):
+        self.level = level
+        self.started = time.monotonic()
+        self.pending = self.total = n
+        self.latencies = []  # enqueue -> delivery, delivered sends only
+
+    def finish(self, now, ok):
+        if ok:
+            self.latencies.append(now - self.started)
+        self.pending -= 1
+        if self.pending:
+            return
+        last = now - self.started
+        ALERT_FANOUT.observe(last, self.level)
+        lat = sorted(self.latencies)
+        log.info(
+            "Fan-out %s %d/%d | p50 %.2fs p95 %.2fs last %.2fs",
+            self.level.upper(), len(lat), self.total, _percentile(lat, 0.5), _percentile(lat, 0.95), last,
+        )
+
+class PendingSend:
+    __slots__ = ("chat_id", "uid", "klass", "alerts", "fanouts", "enqueued", "deadline", "trial")
+
+    def __init__(self, chat_id, uid, klass, alert, fanout, deadline, trial):
+        self.chat_id = chat_id
+        self.uid = uid
+        self.klass = klass
+        self.alerts = [alert]
+        self.fanouts = [fanout]
+        self.enqueued = time.monotonic()
+        self.deadline = deadline
+        self.trial = int(trial)
+
+    def text(self):
+        if len(self.alerts) == 1:
+            return self.alerts[0]
+        plain = "\n\n".join(a.plain for a in self.alerts)
+        if any(a.markdown is None for a in self.alerts):
+            return RenderedAlert(None, plain)
+        return RenderedAlert("\n\n".join(a.markdown for a in self.alerts), plain)
+
+class DeliveryQueue:
+    """
+    Per-chat sends in priority classes: level first (max, medium, min), then
+    premium/channel before trial users. Workers always take the highest
+    non-empty class. A send past its level's deadline is dropped instead of
+    delivered late; above DELIVERY_QUEUE_MAX the oldest sends of the lowest
+    class are shed; pending min alerts to the same chat are merged into one
+    message. A send whose chat is out of rate (a channel at ~20 msg/min, a
+    DM at 1 msg/s) is parked off the classes until the chat's bucket refills,
+    so no worker sits on one slow chat while the others wait. Trials are charged before push (reserve_trials); on_refund(uid, n)
+    gets back every trial send that is dropped or fails. Each pushed alert
+    reports its fan-out time, enqueue to last finished send.
+    """
+    def __init__(self, sender, on_refund=None, workers=SEND_CONCURRENCY, maxlen=DELIVERY_QUEUE_MAX):
+        self.sender = sender
+        self.on_refund = on_refund
+        self.workers = workers
+        self.maxlen = maxlen
+        self.classes = [deque() for _ in range(len(LEVEL_PRIORITY) * 2)]
+        self.coalescing = {}  # chat_id -> queued min send still open for merging
+        self.parked = {}      # chat_id -> sends waiting for the chat's rate limit
+        self.depth = 0
+        self.inflight = 0
+        self.nonempty = asyncio.Event()
+        self.tasks = []
+
+    async def push(self, alert, level, targets, consume_trial=True):
+        prio = LEVEL_PRIORITY.get(level, 0)
+        deadline = time.monotonic() + ALERT_DEADLINES.get(level, 300)
+        low = prio == LEVEL_PRIORITY["min"]
+        fanout = AlertFanout(level, len(targets))
+        for uid, chat_id, tier in targets:
+            trial = consume_trial and tier == 1
+            if low:
+                item = self.coalescing.get(chat_id)
+                if item is not None and len(item.alerts) < COALESCE_MAX:
+                    item.alerts.append(alert)
+                    item.fanouts.append(fanout)
+                    item.trial += trial
+                    DELIVERY_COALESCED.inc()
+                    continue
+            klass = prio * 2 + tier
+            item = PendingSend(chat_id, uid, klass, alert, fanout, deadline, trial)
+            self.classes[klass].append(item)
+            self.depth += 1
+            if low:
+                self.coalescing[chat_id] = item
+        while self.depth > self.maxlen and await self._shed():
+            pass
+        if self.depth:
+            self.nonempty.set()
+        return len(targets)
+
+    def _take(self, item):
+        self.depth -= 1
+        if self.coalescing.get(item.chat_id) is item:
+            del self.coalescing[item.chat_id]
+
+    async def _shed(self):
+        for q in reversed(self.classes):
+            if q:
+                item = q.popleft()
+                break
+        else:
+            if not self.parked:
+                return False
+            # everything left is parked: shed the oldest send of the lowest class there
+            item = max((i for items in self.parked.values() for i in items), key=lambda i: (i.klass, -i.enqueued))
+            self.parked[item.chat_id].remove(item)
+        self._take(item)
+        DELIVERY_DROPS.inc("shed")
+        await self._finish(item, False)
+        return True
+
+    async def _finish(self, item, ok):
+        now = time.monotonic()
+        for fanout in item.fanouts:
+            fanout.finish(now, ok)
+        if not ok and item.trial and self.on_refund is not None:
+            await self.on_refund(item.uid, item.trial)
+
+    def _park(self, item, wait):
+        items = self.parked.get(item.chat_id)
+        if items is None:
+            items = self.parked[item.chat_id] = []
+            asyncio.get_running_loop().call_later(wait, self._unpark, item.chat_id)
+        items.append(item)
+
+    def _unpark(self, chat_id):
+        # back to the front of their classes, in order; the first one takes
+        # the refilled slot and the rest park again until the next
+        items = self.parked.pop(chat_id, ())
+        for item in sorted(items, key=lambda i: (i.klass, i.enqueued), reverse=True):
+            self.classes[item.klass].appendleft(item)
+        if items:
+            self.nonempty.set()
+
+    async def _next(self):
+        while True:
+            for q in self.classes:
+                while q:
+                    item = q.popleft()
+                    # stale sends go straight to the worker to be dropped
+                    if time.monotonic() <= item.deadline:
+                        if item.chat_id in self.parked:
+                            self.parked[item.chat_id].append(item)
+                            continue
+                        wait = self.sender.claim(item.chat_id)
+                        if wait:
+                            self._park(item, wait)
+                            continue
+                    self._take(item)
+                    return item
+            self.nonempty.clear()
+            await self.nonempty.wait()
+
+    async def _worker(self, app):
+        while True:
+            item = await self._next()
+            now = time.monotonic()
+            if now > item.deadline:
+                DELIVERY_DROPS.inc("stale")
+                await self._finish(item, False)
+                continue
+            DELIVERY_WAIT.observe(now - item.enqueued, item.klass)
+            self.inflight += 1
+            ok = False
+            try:
+                ok = await self.sender.send(app, item.chat_id, item.text(), claimed=True)
+                SEND_LATENCY.observe(time.monotonic() - now)
+                if not ok:
+                    SEND_FAILURES.inc()
+            except Exception as e:
+                log.error("Delivery error (chat %s): %s", item.chat_id, e)
+            finally:
+                self.inflight -= 1
+            await self._finish(item, ok)
+
+    def start(self, app):
+        self.tasks = [asyncio.create_task(self._worker(app)) for _ in range(self.workers)]
+
+    async def join(self):
+        while self.depth or self.inflight:
+            await asyncio.sleep(0.05)
+
+async def _refund_trial_local(uid, n):
+    refund_trial(uid, n)
+
+dispatcher = Dispatcher()
+delivery_queue = DeliveryQueue(dispatcher, on_refund=_refund_trial_local)
+Gauge("onion_delivery_queue_depth", "Queued sends per priority class", ("class",),
+      fn=lambda: {**{(str(i), ): len(q) for i, q in enumerate(delivery_queue.classes)},
+                  ("parked", ): sum(map(len, delivery_queue.parked.values()))})
+
+def is_premium(u, now=None):
+    if not u.get("paid"):
+        return False
+    until = u.get("paid_until")
+    return not until or datetime.fromisoformat(until) > (now or datetime.utcnow())
+
+# --------------------------------------------------------------------------- #
+#                               ROUTING                                     #
+# --------------------------------------------------------------------------- #
+SUBSCRIPTION_CHECK_INTERVAL = 60
+
+class RoutingIndex:
+    """
+    (chain, level) -> {uid: chat_id} for every user allowed to receive that
+    alert. Kept up to date by calling update(uid) whenever a user's chat,
+    filters, trial or subscription changes, so an alert's recipients are a
+    dict lookup instead of a scan of all users.
+    """
+    def __init__(self):
+        self.routes = defaultdict(dict)
+        self.keys_by_uid = {}
+        self.premium = set()
+        self.expiry = []  # heap of (paid_until, uid)
+        self.expiry_pushed = {}  # uid -> paid_until of its newest heap entry
+
+    def remove(self, uid):
+        self.premium.discard(uid)
+        for key in self.keys_by_uid.pop(uid, ()):
+            self.routes[key].pop(uid, None)
+
+    def update(self, uid, now=None):
+        self.remove(uid)
+        u = users.get(uid)
+        if not u or not u.get("chat_id"):
+            return
+        now = now or datetime.utcnow()
+        premium = is_premium(u, now)
+        if u.get("free", 0) <= 0 and not premium:
+            return
+        f = u.get("filters", {})
+        joined = set(u.get("channels") or ()) if premium else ()
+        keys = [
+            (chain, level) for chain in f.get("chains", []) for level in f.get("levels", [])
+            if ALERT_CHANNELS.get((chain, level)) not in joined
+        ]
+        for key in keys:
+            self.routes[key][uid] = u["chat_id"]
+        self.keys_by_uid[uid] = keys
+        if premium:
+            self.premium.add(uid)
+        if premium and u.get("paid_until"):
+            until = datetime.fromisoformat(u["paid_until"])
+            # filter and /settings updates keep the expiry; only a new one is pushed
+            if self.expiry_pushed.get(uid) != until:
+                self.expiry_pushed[uid] = until
+                heapq.heappush(self.expiry, (until, uid))
+
+    def rebuild(self):
+        self.routes.clear()
+        self.keys_by_uid.clear()
+        self.premium.clear()
+        self.expiry.clear()
+        self.expiry_pushed.clear()
+        now = datetime.utcnow()
+        for uid in list(users):
+            self.update(uid, now)
+
+    def expire_due(self, now=None):
+        now = now or datetime.utcnow()
+        expired = []
+        while self.expiry and self.expiry[0][0] <= now:
+            until, uid = heapq.heappop(self.expiry)
+            if self.expiry_pushed.get(uid) == until:
+                del self.expiry_pushed[uid]
+            # a renewed user may still have an old heap entry; update() re-checks
+            self.update(uid, now)
+            expired.append(uid)
+        return expired
+
+    def recipients(self, chain, level):
+        """(uid, chat_id) pairs for DMs, plus (None, channel) when the key has a channel."""
+        out = list(self.routes.get((chain, level), {}).items())
+        channel = ALERT_CHANNELS.get((chain, level))
+        if channel:
+            out.append((None, channel))
+        return out
+
+    def targets(self, chain, level):
+        """recipients() with a delivery tier: 0 for premium users and channels, 1 for trials."""
+        premium = self.premium
+        return [
+            (uid, chat_id, 0 if uid is None or uid in premium else 1)
+            for uid, chat_id in self.recipients(chain, level)
+        ]
+
+routing = RoutingIndex()
+
+async def expire_subscriptions(app):
+    while True:
+        await asyncio.sleep(SUBSCRIPTION_CHECK_INTERVAL)
+        expired = routing.expire_due()
+        if expired:
+            log.info("Routing: subscription expiry check applied")
+        for uid in expired:
+            u = users.get(uid)
+            if u and u.get("channels") and not is_premium(u):
+                await remove_from_channels(app, uid)
+
+def reserve_trials(targets, consume_trial=True):
+    """
+    Charge trial targets when their send is queued rather than when it lands,
+    so a burst can never queue more alerts than a user has left. Targets with
+    no trial left are dropped; refund_trial() returns unsent ones.
+    """
+    if not consume_trial:
+        return targets
+    kept = []
+    for target in targets:
+        uid, _, tier = target
+        if tier == 1:
+            u = users.get(uid)
+            if not u or u.get("free", 0) <= 0:
+                continue
+            u["free"] -= 1
+            users.touch(uid)
+            if u["free"] == 0:
+                routing.update(uid)
+        kept.append(target)
+    return kept
+
+def refund_trial(uid, n=1):
+    u = users.get(uid)
+    if not u:
+        return
+    was = u.get("free", 0)
+    u["free"] = was + n
+    users.touch(uid)
+    if was <= 0:
+        routing.update(uid)
+
+async def deliver_alert(app, chain, level, msg, consume_trial=True):
+    targets = reserve_trials(routing.targets(chain, level), consume_trial)
+    return await delivery_queue.push(msg, level, targets, consume_trial)
+
+async def emit_alert(app, chain, level, msg, consume_trial=True):
+    """
+    Scanner-side entry point. Queues the alert in-process in single mode and
+    returns the number of targets; in split mode the alert goes to the bot
+    process, which owns users and routing, and the count is not known here.
+    """
+    ALERTS.inc(chain, level)
+    if broker is None:
+        return await deliver_alert(app, chain, level, msg, consume_trial)
+    await broker.publish("alerts", (chain, level, msg, consume_trial))
+    return None
+
+# --------------------------------------------------------------------------- #
+#                               DECODING                                    #
+# --------------------------------------------------------------------------- #
+json_loads = orjson.loads if orjson is not None else json.loads
+
+def safe_float(val, default=0.0):
+    if val is None or val == "":
+        return default
+    try:
+        return float(val)
+    except:
+        return default
+
+CHAIN_NAMES = {"solana": "SOL", "bsc": "BSC"}
+
+class TokenSnapshot:
+    """
+    One token as seen in one poll, normalised once (str/sliced symbol and
+    address, float metrics) and shared by classification, formatting, the
+    debug log and the volume history, for both PUMP and DEX sources.
+    """
+    __slots__ = ("chain", "addr", "sym", "liq", "fdv", "vol", "pair", "src")
+
+    def __init__(self, chain, addr, sym, liq, fdv, vol, pair=None, src=""):
+        self.chain = chain
+        self.addr = addr
+        self.sym = sym
+        self.liq = liq
+        self.fdv = fdv
+        self.vol = vol
+        self.pair = pair
+        self.src = src
+
+    @classmethod
+    def from_moralis(cls, t):
+        fdv = safe_float(t.get("fullyDilutedValuation") or t.get("fdv"))
+        liq = safe_float(t.get("liquidity"))
+        if liq == 0 and fdv > 0:
+            liq = fdv * 0.12
+        vol_5m = t.get("volume_5m")
+        vol = safe_float(vol_5m or t.get("volume"))
+        if not vol_5m and vol > 0:
+            vol = vol / 288
+        return cls(
+            "PUMP",
+            str(t.get("tokenAddress") or t.get("mint") or "")[:64],
+            str(t.get("symbol") or "PUMP")[:20],
+            liq, fdv, vol,
+            src="NEW" if "new" in (t.get("tags") or ()) else "GRAD",
+        )
+
+    @classmethod
+    def from_birdeye(cls, p, chain):
+        base = p.get("baseToken") or {}
+        return cls(
+            chain,
+            str(base.get("address") or "")[:64],
+            str(base.get("symbol") or "???")[:20],
+            safe_float((p.get("liquidity") or {}).get("usd")),
+            safe_float(p.get("fdv")),
+            safe_float((p.get("volume") or {}).get("m5")),
+            pair=p.get("pairAddress"),
+            src="DEX",
+        )
+
+def project_moralis(body):
+    # decode once, keep only compact snapshots; the full dicts die here
+    return [TokenSnapshot.from_moralis(t) for t in json_loads(body).get("result") or []]
+
+def project_birdeye(body, chain, limit=50):
+    pairs = (json_loads(body).get("data") or {}).get("pairs") or []
+    return [TokenSnapshot.from_birdeye(p, chain) for p in pairs[:limit]]
 
 # --------------------------------------------------------------------------- #
 #                               HELPERS                                     #
@@ -147,41 +1267,111 @@ def dex_url(chain, pair):
 def pump_url(ca):
     return f"https://pump.fun/{ca}"
 
-def format_alert(chain, sym, addr, liq, fdv, vol, pair, level):
-    e = {"min":"Min","medium":"Medium","max":"Max","large_buy":"SNIPE","upgrade":"UPGRADED"}.get(level, level.upper())
-    
+ALERT_LABELS = {"min": "Min", "medium": "Medium", "max": "Max", "large_buy": "SNIPE", "upgrade": "UPGRADED"}
+MD_SPECIAL_RE = re.compile(r"([_*\[\]()~`>#+\-=|{}.!\\])")
+_md_labels = {}
+
+def md_escape(text):
+    return MD_SPECIAL_RE.sub(r"\\\1", text)
+
+def md_label(text):
+    # chain and level labels are a small fixed set: escape each one once
+    esc = _md_labels.get(text)
+    if esc is None:
+        esc = _md_labels[text] = md_escape(text)
+    return esc
+
+def markdown_v2_ok(text):
+    """
+    Structural MarkdownV2 check: reserved characters escaped, entities
+    closed, links complete. Catches what Telegram would reject with
+    "can't parse entities" before the text is sent to anyone.
+    """
+    open_marks = []
+    in_code = in_url = False
+    i, n = 0, len(text)
+    while i < n:
+        c = text[i]
+        if c == "\\":
+            i += 2
+            continue
+        if in_code:
+            in_code = c != "`"
+        elif in_url:
+            in_url = c != ")"
+        elif c == "`":
+            in_code = True
+        elif c in "*_~|":
+            if c == "|" and text[i:i + 2] != "||":
+                return False
+            if open_marks and open_marks[-1] == c:
+                open_marks.pop()
+            else:
+                open_marks.append(c)
+            i += 1 if c != "|" else 2
+            continue
+        elif c == "[":
+            open_marks.append("[")
+        elif c == "]":
+            if not open_marks or open_marks[-1] != "[" or text[i + 1:i + 2] != "(":
+                return False
+            open_marks.pop()
+            in_url = True
+            i += 1
+        elif c in "()>#+-=}{.!":
+            return False
+        i += 1
+    return not open_marks and not in_code and not in_url
+
+class RenderedAlert:
+    """An alert rendered once for all recipients; markdown is None when unusable."""
+    __slots__ = ("markdown", "plain")
+
+    def __init__(self, markdown, plain):
+        self.markdown = markdown
+        self.plain = plain
+
+def format_alert(snap, level, route=None):
+    label = ALERT_LABELS.get(level) or level.upper()
+    if level == "upgrade" and route:
+        # keep the level reached in the title, e.g. a min -> max spike
+        label = f"{label} → {ALERT_LABELS[route]}"
+    chain, liq, fdv, vol = snap.chain, snap.liq, snap.fdv, snap.vol
+
     if chain == "PUMP":
-        link = pump_url(addr)
+        link = pump_url(snap.addr)
     else:
-        pair = pair or addr
-        link = dex_url(chain, pair)
-
-    # SAFE SYMBOL
-    sym = str(sym) if not isinstance(sym, str) else sym
-    sym = sym[:20]
-    sym_esc = escape_markdown(sym, version=2)
+        link = dex_url(chain, snap.pair or snap.addr)
 
     # SAFE ADDRESS
-    addr = str(addr) if not isinstance(addr, str) else addr
-    addr = ''.join(c for c in addr if c.isalnum() or c in "+/=")[:64]
+    addr = ''.join(c for c in snap.addr if c.isalnum() or c in "+/=")
     addr_short = addr[:8] + "..." + addr[-6:] if len(addr) >= 14 else addr
-    addr_esc = escape_markdown(addr_short, version=2)
-
-    chain_esc = escape_markdown(chain, version=2)
-    level_esc = escape_markdown(e, version=2)
-
-    return (
-        f"*{level_esc} ALERT* [{chain_esc}]\n"
-        f"`{sym_esc}`\n"
-        f"*CA:* `{addr_esc}`\n"
-        f"Liq: ${liq:,.0f} \\| FDV: ${fdv:,.0f}\n"
-        f"5m Vol: ${vol:,.0f}\n"
+    metrics = f"Liq: ${liq:,.0f} | FDV: ${fdv:,.0f}\n5m Vol: ${vol:,.0f}\n"
+    metrics_md = metrics.replace("|", "\\|")
+
+    markdown = (
+        f"*{md_label(label)} ALERT* \\[{md_label(chain)}\\]\n"
+        f"`{md_escape(snap.sym)}`\n"
+        f"*CA:* `{md_escape(addr_short)}`\n"
+        f"{metrics_md}"
         f"[View]({link})"
     )
+    plain = f"{label} ALERT [{chain}]\n{snap.sym}\nCA: {addr_short}\n{metrics}{link}"
+    if not markdown_v2_ok(markdown):
+        log.warning("Alert %s %s failed MarkdownV2 validation, sending plain text", level, snap.addr)
+        markdown = None
+    return RenderedAlert(markdown, plain)
 # ──────────────────────────────────────────────────────────────
 #  DEBUG HELPER – MUST BE OUTSIDE ANY FUNCTION
 # ──────────────────────────────────────────────────────────────
-def _debug_token(token: dict, addr: str, sym: str, fdv: float, liq: float, vol: float) -> str:
+def _skip_reason(snap):
+    if snap.fdv < 1000:
+        return "FDV<1k"
+    if snap.vol < 50:
+        return "Vol<50"
+    return ""
+
+def _debug_token(snap: TokenSnapshot) -> str:
     """
     Returns a one-line debug string that tells you:
       • Symbol & address (short)
@@ -189,98 +1379,918 @@ def _debug_token(token: dict, addr: str, sym: str, fdv: float, liq: float, vol:
       • Source (NEW or GRADUATED)
       • Why it was skipped (if any)
     """
-    src = "NEW" if "new" in token.get("tags", []) else "GRAD"
-    short = addr[:6] + "…" + addr[-4:]
-
-    reason = ""
-    if fdv < 1000:
-        reason = "FDV<1k"
-    elif vol < 50:
-        reason = "Vol<50"
+    sym, fdv, liq, vol = snap.sym, snap.fdv, snap.liq, snap.vol
+    short = snap.addr[:6] + "…" + snap.addr[-4:]
+    reason = _skip_reason(snap)
 
     return (
         f"PUMP DEBUG → {sym:<12} | {short} | "
         f"FDV ${fdv:>8,.0f} | Liq ${liq:>7,.0f} | Vol ${vol:>6,.0f} "
-        f"| {src} {reason}"
+        f"| {snap.src} {reason}"
     )
 
+def track_volume(snap):
+    """Append snap.vol to the token's volume history; True if it is a spike."""
+    ring = pump_vol_ring if snap.chain == "PUMP" else dex_vol_ring
+    return ring.push([snap.addr], [snap.vol])[0]
 
+# --------------------------------------------------------------------------- #
+#                               HTTP CLIENT                                 #
+# --------------------------------------------------------------------------- #
+UPSTREAM_LIMITS = {
+    # name: (timeout s, max retries, max concurrent connections)
+    "moralis": (15, 1, 8),
+    "birdeye": (15, 1, 8),
+    "goplus": (10, 1, 4),
+    "solana": (8, 2, 10),
+    "bscscan": (10, 1, 2),
+}
+RETRY_BUDGET_MAX = 10       # retries an upstream may bank
+RETRY_BUDGET_EARN = 0.1     # retry tokens earned per request (~10% retries)
+BREAKER_THRESHOLD = 5       # consecutive failures before the breaker opens
+BREAKER_COOLDOWN = 30       # seconds open before a trial request
+
+class UpstreamUnavailable(Exception):
+    pass
+
+class CircuitBreaker:
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        # half-open: let one trial through per cooldown period
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            self.opened_at = time.monotonic()
+            return True
+        return False
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+class Upstream:
+    def __init__(self, timeout, retries, concurrency):
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.retries = retries
+        self.sem = asyncio.Semaphore(concurrency)
+        self.breaker = CircuitBreaker()
+        self.retry_budget = RETRY_BUDGET_MAX
+
+class EndpointStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.status = defaultdict(int)
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+
+    def record(self, status, latency):
+        self.calls += 1
+        self.status[status] += 1
+        if status != 200 and status != 304:
+            self.errors += 1
+        self.latency_sum += latency
+        self.latency_max = max(self.latency_max, latency)
+
+    def summary(self):
+        avg = self.latency_sum / self.calls if self.calls else 0.0
+        return f"calls {self.calls} err {self.errors} avg {avg:.2f}s max {self.latency_max:.2f}s status {dict(self.status)}"
+
+endpoint_stats = defaultdict(EndpointStats)
+
+class HttpResult:
+    __slots__ = ("status", "headers", "body")
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return json_loads(self.body)
+
+class HttpClient:
+    """
+    One pooled aiohttp session for every upstream: keep-alive connections,
+    cached DNS, and per-upstream timeout, concurrency limit, retry budget
+    and circuit breaker, so a slow upstream cannot starve the others.
+    """
+    def __init__(self, limits=UPSTREAM_LIMITS):
+        self.sess = None
+        self.upstreams = {name: Upstream(*cfg) for name, cfg in limits.items()}
+
+    def _session(self):
+        if self.sess is None or self.sess.closed:
+            connector = aiohttp.TCPConnector(
+                limit=100,
+                limit_per_host=20,
+                ttl_dns_cache=300,
+                keepalive_timeout=60,
+            )
+            self.sess = aiohttp.ClientSession(connector=connector)
+        return self.sess
+
+    async def request(self, upstream, method, url, label=None, **kwargs):
+        up = self.upstreams[upstream]
+        if not up.breaker.allow():
+            raise UpstreamUnavailable(f"{upstream} circuit open")
+        up.retry_budget = min(RETRY_BUDGET_MAX, up.retry_budget + RETRY_BUDGET_EARN)
+        stats = endpoint_stats[label or upstream]
+        attempt = 0
+        while True:
+            status = 0
+            t0 = time.monotonic()
+            try:
+                async with up.sem:
+                    async with self._session().request(method, url, timeout=up.timeout, **kwargs) as resp:
+                        status = resp.status
+                        result = HttpResult(resp.status, resp.headers, await resp.read())
+                error = status == 429 or status >= 500
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                result, error = e, True
+            latency = time.monotonic() - t0
+            stats.record(status, latency)
+            UPSTREAM_REQUESTS.inc(label or upstream, status)
+            UPSTREAM_LATENCY.observe(latency, label or upstream)
+            if not error:
+                up.breaker.success()
+                return result
+            up.breaker.failure()
+            if attempt >= up.retries or up.retry_budget < 1 or not up.breaker.allow():
+                if isinstance(result, Exception):
+                    raise result
+                return result
+            up.retry_budget -= 1
+            attempt += 1
+            await asyncio.sleep(0.5 * 2 ** attempt)
+
+    def ws_connect(self, url, **kwargs):
+        return self._session().ws_connect(url, heartbeat=30, **kwargs)
+
+    async def close(self):
+        if self.sess is not None:
+            await self.sess.close()
+
+http = HttpClient()
 
 # --------------------------------------------------------------------------- #
 #                               RUG / BUY                                   #
 # --------------------------------------------------------------------------- #
-async def is_safe_batch(addrs, chain, sess):
-    if not addrs:
-        return {}
-    if chain in ["SOL", "PUMP"]:
-        # GoPlus doesn't support Solana/Pump — skip or use alternative
-        return {a: True for a in addrs}
-    
-    chain_id = 56  # BSC only
-    url = GOPLUS_API.format(chain_id=chain_id, addrs=",".join(addrs))
-    now = time.time()
-    cached = {a: goplus_cache[a][0] for a in addrs if a in goplus_cache and now - goplus_cache[a][1] < 3600}
-    to_check = [a for a in addrs if a not in cached]
-    results = cached.copy()
-    if not to_check:
-        return results
-    try:
-        async with sess.get(url, timeout=10) as resp:
+GOPLUS_URL_MAX = 1800        # keep request URLs well under common 2 KB limits
+GOPLUS_NEGATIVE_TTL = 600    # unsafe verdicts are re-checked sooner than safe ones
+GOPLUS_ERROR_TTL = 45        # failed lookups retry on the next DEX cycle
+
+class GoPlusClient:
+    """
+    GoPlus token_security lookups for BSC. Only cache misses are requested,
+    split into URL-length-safe chunks sent concurrently; concurrent callers
+    asking for the same address wait on the same in-flight lookup.
+    """
+    def __init__(self, chain_id=56):
+        self.chain_id = chain_id
+        self.inflight = {}
+
+    def _chunks(self, addrs):
+        base = len(GOPLUS_API.format(chain_id=self.chain_id, addrs=""))
+        chunk, size = [], base
+        for a in addrs:
+            if chunk and size + len(a) + 1 > GOPLUS_URL_MAX:
+                yield chunk
+                chunk, size = [], base
+            chunk.append(a)
+            size += len(a) + 1
+        if chunk:
+            yield chunk
+
+    async def _fetch(self, chunk, futs):
+        url = GOPLUS_API.format(chain_id=self.chain_id, addrs=",".join(chunk))
+        try:
+            resp = await http.request("goplus", "GET", url)
             if resp.status != 200:
-                raise ValueError()
-            payload = await resp.json()
-            for addr in to_check:
-                info = payload.get("result", {}).get(addr.lower(), {})
+                raise ValueError(f"GoPlus HTTP {resp.status}")
+            payload = resp.json().get("result") or {}
+            for addr in chunk:
+                info = payload.get(addr.lower(), {})
                 safe = (
                     info.get("is_open_source") == "1" and
                     info.get("honeypot") == "0" and
                     info.get("can_take_back_ownership") != "1"
                 )
-                results[addr] = safe
-                goplus_cache[addr] = (safe, now)
-    except:
-        for addr in to_check:
-            results[addr] = False
-    return results
+                goplus_cache.set(addr, safe, None if safe else GOPLUS_NEGATIVE_TTL)
+                futs[addr].set_result(safe)
+        except Exception as e:
+            log.warning("GoPlus error (%d addrs): %s", len(chunk), e)
+            for addr in chunk:
+                goplus_cache.set(addr, False, GOPLUS_ERROR_TTL)
+        finally:
+            for addr in chunk:
+                self.inflight.pop(addr, None)
+                if not futs[addr].done():
+                    futs[addr].set_result(False)
+
+    async def check(self, addrs):
+        results, waiting, misses = {}, {}, []
+        for a in dict.fromkeys(addrs):
+            safe = goplus_cache.get_fresh(a)
+            if safe is not None:
+                results[a] = safe
+            elif a in self.inflight:
+                waiting[a] = self.inflight[a]
+            else:
+                misses.append(a)
+        if misses:
+            loop = asyncio.get_running_loop()
+            futs = {a: loop.create_future() for a in misses}
+            self.inflight.update(futs)
+            waiting.update(futs)
+            await asyncio.gather(*(self._fetch(c, futs) for c in self._chunks(misses)))
+        for a, fut in waiting.items():
+            results[a] = await fut
+        return results
+
+goplus = GoPlusClient()
+
+async def is_safe_batch(addrs, chain):
+    if not addrs:
+        return {}
+    if chain in ["SOL", "PUMP"]:
+        # GoPlus doesn't support Solana/Pump — skip or use alternative
+        return {a: True for a in addrs}
+    return await goplus.check(addrs)
+
+class SolanaRPC:
+    """
+    Minimal async JSON-RPC client for SOLANA_RPC. getTransaction lookups go out
+    as a single batch request. Transactions are immutable, so only the fee
+    payer's balance change is kept per signature and a signature is never
+    fetched twice while it is cached.
+    """
+    TX_CACHE_MAX = 5000
+    TX_CACHE_TTL = 3600
+
+    def __init__(self, url=SOLANA_RPC):
+        self.url = url
+        self.payer_deltas = ExpiringMap("tx_payer_deltas", self.TX_CACHE_TTL, self.TX_CACHE_MAX)
+
+    async def _post(self, payload):
+        resp = await http.request("solana", "POST", self.url, json=payload)
+        return resp.json()
+
+    async def call(self, method, params):
+        resp = await self._post({"jsonrpc": "2.0", "id": 1, "method": method, "params": params})
+        return resp.get("result")
+
+    async def batch(self, calls):
+        if not calls:
+            return []
+        payload = [
+            {"jsonrpc": "2.0", "id": i, "method": method, "params": params}
+            for i, (method, params) in enumerate(calls)
+        ]
+        resp = await self._post(payload)
+        if not isinstance(resp, list):
+            return [None] * len(calls)
+        by_id = {r.get("id"): r.get("result") for r in resp if isinstance(r, dict)}
+        return [by_id.get(i) for i in range(len(calls))]
+
+    async def get_payer_deltas(self, sigs):
+        """Lamports each transaction took from account 0; None where unknown."""
+        cache = self.payer_deltas
+        missing = [s for s in sigs if s not in cache]
+        if missing:
+            # balances are in meta for every encoding; plain json is the smallest
+            results = await self.batch([
+                ("getTransaction", [sig, {"encoding": "json", "maxSupportedTransactionVersion": 0}]) for sig in missing
+            ])
+            for sig, tx in zip(missing, results):
+                try:
+                    meta = tx["meta"]
+                    cache[sig] = meta["preBalances"][0] - meta["postBalances"][0]
+                except (TypeError, KeyError, IndexError):
+                    pass
+        return [cache.get(s) for s in sigs]
+
+solana_rpc = SolanaRPC()
 
-async def detect_large_buy(addr, chain):
+async def detect_large_buy(addr, chain, rpc):
     if chain != "SOL":
         return False
     try:
-        payload = {"jsonrpc": "2.0", "id": 1, "method": "getSignaturesForAddress", "params": [addr, {"limit": 20}]}
-        resp = requests.post(SOLANA_RPC, json=payload, timeout=8).json()
-        for sig in resp.get("result", [])[:5]:
-            tx = requests.post(SOLANA_RPC, json={
-                "jsonrpc": "2.0", "id": 1,
-                "method": "getTransaction",
-                "params": [sig["signature"], {"encoding": "jsonParsed"}]
-            }, timeout=8).json()
-            if tx.get("result"):
-                pre, post = tx["result"]["meta"]["preBalances"][0], tx["result"]["meta"]["postBalances"][0]
-                if (pre - post) / 1e9 * 180 > 2000:
-                    return True
+        sigs = await rpc.call("getSignaturesForAddress", [addr, {"limit": 20}]) or []
+        deltas = await rpc.get_payer_deltas([s["signature"] for s in sigs[:5]])
+        for delta in deltas:
+            if delta is not None and delta / 1e9 * 180 > 2000:
+                return True
     except:
         pass
     return False
 
-def get_alert_level(liq, fdv, vol, new, spike, buy, chain="SOL"):
-    if chain == "PUMP":
-        if vol >= 500 and fdv >= 4000:
+# --------------------------------------------------------------------------- #
+#                               PAYMENTS                                    #
+# --------------------------------------------------------------------------- #
+BSCSCAN_CACHE_TTL = 20
+PAYMENT_POLL_INTERVAL = 30
+PENDING_PAYMENT_TTL = 1800
+
+class BscScanClient:
+    """
+    Async reader for the wallet's latest USDT transfers. The page is cached for
+    BSCSCAN_CACHE_TTL seconds and concurrent callers share one in-flight
+    request, so a burst of /pay commands costs a single upstream call.
+    """
+    def __init__(self, url=BSCSCAN_API, wallet=WALLETS["BSC"]):
+        self.url = url
+        self.params = {"module": "account", "action": "tokentx", "address": wallet, "page": 1, "offset": 20}
+        self.cached = None
+        self.cached_at = 0.0
+        self.inflight = None
+
+    async def _fetch(self):
+        payload = (await http.request("bscscan", "GET", self.url, params=self.params)).json()
+        result = payload.get("result")
+        if not isinstance(result, list):
+            raise ValueError(f"BscScan: {result}")
+        self.cached, self.cached_at = result, time.time()
+        return result
+
+    async def recent_transfers(self):
+        if self.cached is not None and time.time() - self.cached_at < BSCSCAN_CACHE_TTL:
+            return self.cached
+        if self.inflight is None:
+            self.inflight = asyncio.ensure_future(self._fetch())
+            self.inflight.add_done_callback(lambda _: setattr(self, "inflight", None))
+        return await asyncio.shield(self.inflight)
+
+bscscan = BscScanClient()
+
+def match_payment(transfers, txid):
+    for tx in transfers:
+        if tx.get("hash", "").lower() == txid and tx.get("tokenSymbol") == "USDT":
+            return tx
+    return None
+
+def confirm_payment(uid, tx):
+    value = float(tx.get("value", "0")) / 1e6
+    if value < PRICE_USDT or uid not in users:
+        return False
+    users[uid]["paid"] = True
+    users[uid]["paid_until"] = (datetime.utcnow() + timedelta(days=30)).isoformat()
+    users[uid]["free"] = 0
+    users.touch(uid)
+
+    user = users[uid]
+    source = user.get("source", "organic")
+    influencer = source.split("_", 1)[1] if "_" in source else None
+    if influencer:
+        tracker.setdefault(influencer, {"joins": 0, "subs": 0, "revenue": 0.0})
+        tracker[influencer]["subs"] += 1
+        tracker[influencer]["revenue"] += PRICE_USDT
+        tracker.touch(influencer)
+    routing.update(uid)
+    return True
+
+async def payment_poller(app: Application):
+    while True:
+        await asyncio.sleep(PAYMENT_POLL_INTERVAL)
+        if not pending_payments:
+            continue
+        try:
+            transfers = await bscscan.recent_transfers()
+        except Exception as e:
+            log.warning(f"Payment poll error: {e}")
+            continue
+        now = time.time()
+        for txid, p in list(pending_payments.items()):
+            tx = match_payment(transfers, txid)
+            if tx is not None:
+                pending_payments.pop(txid, None)
+                if confirm_payment(p["uid"], tx):
+                    log.info(f"Payment auto-confirmed for {p['uid']}")
+                    await safe_send(app, p["chat_id"], "*Payment confirmed\\!* Premium active\\." + channel_invite_text(p["uid"]))
+                else:
+                    await safe_send(app, p["chat_id"], "Invalid TXID\\.")
+            elif now - p["ts"] > PENDING_PAYMENT_TTL:
+                pending_payments.pop(txid, None)
+                await safe_send(app, p["chat_id"], "Could not confirm your payment\\. Check the TXID and send `/pay` again\\.")
+
+# --------------------------------------------------------------------------- #
+#                               CHANNELS                                    #
+# --------------------------------------------------------------------------- #
+channel_invites = {}  # channel chat_id -> join-request invite link
+
+def channel_labels():
+    labels = defaultdict(list)
+    for (chain, level), channel in ALERT_CHANNELS.items():
+        labels[channel].append(f"{chain} {level}")
+    return labels
+
+async def setup_channels(app):
+    # one join-request link per channel; only premium users get approved
+    for channel in set(ALERT_CHANNELS.values()):
+        try:
+            link = await app.bot.create_chat_invite_link(channel, name="premium", creates_join_request=True)
+            channel_invites[channel] = link.invite_link
+        except Exception as e:
+            log.warning("Channel %s: cannot create invite link: %s", channel, e)
+
+def channel_invite_text(uid):
+    """MarkdownV2 lines with the invite links matching the user's filters."""
+    f = (users.get(uid) or {}).get("filters", {})
+    wanted = {
+        ALERT_CHANNELS[(chain, level)]
+        for chain in f.get("chains", []) for level in f.get("levels", [])
+        if (chain, level) in ALERT_CHANNELS
+    }
+    labels = channel_labels()
+    lines = [
+        f"[Join {md_escape(', '.join(labels[ch]))}]({channel_invites[ch]})"
+        for ch in sorted(wanted) if ch in channel_invites
+    ]
+    return "\n\nAlert channels:\n" + "\n".join(lines) if lines else ""
+
+async def remove_from_channels(app, uid):
+    u = users[uid]
+    for channel in u.get("channels") or []:
+        try:
+            # ban + unban removes the member but lets them rejoin after renewing
+            await app.bot.ban_chat_member(channel, uid)
+            await app.bot.unban_chat_member(channel, uid, only_if_banned=True)
+        except Exception as e:
+            log.warning("Channel %s: cannot remove %s: %s", channel, uid, e)
+    u["channels"] = []
+    users.touch(uid)
+    routing.update(uid)
+
+async def prune_channel_members(app):
+    # a subscription that lapsed while the bot was down never reaches the
+    # expiry heap (only premium users are pushed), so catch those at start
+    lapsed = [uid for uid, u in users.items() if u.get("channels") and not is_premium(u)]
+    for uid in lapsed:
+        await remove_from_channels(app, uid)
+    if lapsed:
+        log.info("Channels: removed %d lapsed member(s)", len(lapsed))
+
+async def join_request(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    req = update.chat_join_request
+    if req.chat.id not in channel_invites:
+        return
+    uid = req.from_user.id
+    u = users.get(uid)
+    if not u or not is_premium(u):
+        await req.decline()
+        return
+    await req.approve()
+    joined = u.setdefault("channels", [])
+    if req.chat.id not in joined:
+        joined.append(req.chat.id)
+    users.touch(uid)
+    routing.update(uid)
+    log.info("Channel %s: approved %s", req.chat.id, uid)
+
+async def channel_member(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    # a member who leaves on their own gets DMs again
+    cm = update.chat_member
+    uid = cm.new_chat_member.user.id
+    u = users.get(uid)
+    if not u or cm.chat.id not in (u.get("channels") or ()):
+        return
+    if cm.new_chat_member.status in ("left", "kicked"):
+        u["channels"].remove(cm.chat.id)
+        users.touch(uid)
+        routing.update(uid)
+
+# --------------------------------------------------------------------------- #
+#                               CLASSIFICATION                              #
+# --------------------------------------------------------------------------- #
+ALERT_THRESHOLDS = {
+    "PUMP": {
+        "min_vol": 500, "min_fdv": 4000,
+        "medium_vol": 3000, "medium_fdv": 50000, "medium_liq": 10000,
+        "max_vol": 500,
+    },
+    "DEX": {
+        "min_liq": 1000, "min_fdv": 10000, "min_vol": 500,
+        "medium_liq": 25000, "medium_fdv": 70000, "medium_vol": 3000,
+    },
+}
+SPIKE_FACTOR = 2.0
+LEVEL_CODES = (None, "min", "medium", "max")
+
+def get_alert_level(snap, new, spike, buy, thresholds=ALERT_THRESHOLDS):
+    liq, fdv, vol = snap.liq, snap.fdv, snap.vol
+    if snap.chain == "PUMP":
+        t = thresholds["PUMP"]
+        if vol >= t["min_vol"] and fdv >= t["min_fdv"]:
             return "min"
-        if vol >= 3000 and fdv >= 50000 and liq >= 10000:
+        if vol >= t["medium_vol"] and fdv >= t["medium_fdv"] and liq >= t["medium_liq"]:
             return "medium"
-        if spike and vol >= 500:
+        if spike and vol >= t["max_vol"]:
             return "max"
         return None
     else:
-        if new and liq >= 1000 and fdv >= 10000 and vol >= 500:
+        t = thresholds["DEX"]
+        if new and liq >= t["min_liq"] and fdv >= t["min_fdv"] and vol >= t["min_vol"]:
             return "min"
-        if liq >= 25000 and fdv >= 70000 and vol >= 3000:
+        if liq >= t["medium_liq"] and fdv >= t["medium_fdv"] and vol >= t["medium_vol"]:
             return "medium"
         if buy and spike:
             return "max"
     return None
 
+def level_codes(liq, fdv, vol, pump, spike, buy, new, thresholds=ALERT_THRESHOLDS):
+    # array form of get_alert_level: 0 = no alert, else index into LEVEL_CODES
+    p, d = thresholds["PUMP"], thresholds["DEX"]
+    pump_code = np.select([
+        (vol >= p["min_vol"]) & (fdv >= p["min_fdv"]),
+        (vol >= p["medium_vol"]) & (fdv >= p["medium_fdv"]) & (liq >= p["medium_liq"]),
+        spike & (vol >= p["max_vol"]),
+    ], [1, 2, 3], 0)
+    dex_code = np.select([
+        new & (liq >= d["min_liq"]) & (fdv >= d["min_fdv"]) & (vol >= d["min_vol"]),
+        (liq >= d["medium_liq"]) & (fdv >= d["medium_fdv"]) & (vol >= d["medium_vol"]),
+        buy & spike,
+    ], [1, 2, 3], 0)
+    return np.where(pump, pump_code, dex_code)
+
+def classify_batch(snaps, spikes, buys, new=True, thresholds=ALERT_THRESHOLDS):
+    """Alert level for every snapshot of a poll cycle in one pass."""
+    if np is None or not snaps:
+        return [get_alert_level(s, new, sp, b, thresholds) for s, sp, b in zip(snaps, spikes, buys)]
+    n = len(snaps)
+    codes = level_codes(
+        np.fromiter((s.liq for s in snaps), np.float64, n),
+        np.fromiter((s.fdv for s in snaps), np.float64, n),
+        np.fromiter((s.vol for s in snaps), np.float64, n),
+        np.fromiter((s.chain == "PUMP" for s in snaps), bool, n),
+        np.asarray(spikes, dtype=bool),
+        np.asarray(buys, dtype=bool),
+        bool(new),
+        thresholds,
+    )
+    return [LEVEL_CODES[c] for c in codes.tolist()]
+
+class VolumeRing:
+    """
+    Per-token rolling window of 5m volumes plus the spike rule applied to it.
+    mode "pump": spike if vol >= 2x the mean of the earlier positive values.
+    mode "dex":  spike if vol / mean(window incl. current) >= 2.
+    With NumPy the windows live in one (slots x window) array and a whole
+    cycle is pushed at once; otherwise a deque per token is used. Token ->
+    slot is an ExpiringMap, so idle tokens give their slot back. Addresses
+    in one push() must be unique.
+    """
+    def __init__(self, name, window, mode, capacity=1024):
+        self.window = window
+        self.mode = mode
+        if np is None:
+            self.hist = ExpiringMap(name, *VOL_HIST_LIMITS, factory=lambda: deque(maxlen=window))
+            return
+        self.slots = ExpiringMap(name, *VOL_HIST_LIMITS, on_evict=lambda _, slot: self.free.append(slot))
+        self.free = []
+        self.next_slot = 0
+        self.buf = np.zeros((capacity, window))
+        self.count = np.zeros(capacity, dtype=np.int64)
+        self.head = np.zeros(capacity, dtype=np.int64)
+
+    def _slot(self, addr):
+        slot = self.slots.get(addr)
+        if slot is not None:
+            self.slots.touch(addr)
+            return slot
+        if self.free:
+            slot = self.free.pop()
+        else:
+            slot = self.next_slot
+            self.next_slot += 1
+            if slot >= len(self.count):
+                grow = len(self.count)
+                self.buf = np.vstack([self.buf, np.zeros((grow, self.window))])
+                self.count = np.concatenate([self.count, np.zeros(grow, dtype=np.int64)])
+                self.head = np.concatenate([self.head, np.zeros(grow, dtype=np.int64)])
+        self.count[slot] = 0
+        self.head[slot] = 0
+        self.slots[addr] = slot
+        return slot
+
+    def _push_one(self, addr, vol):
+        h = self.hist[addr]
+        h.append(vol)
+        self.hist.touch(addr)
+        if self.mode == "pump":
+            recent_prev = [v for v in list(h)[:-1] if v > 0]
+            if not recent_prev:
+                return False
+            return vol >= (sum(recent_prev) / len(recent_prev)) * SPIKE_FACTOR
+        avg = sum(h) / len(h)
+        return len(h) > 1 and avg > 0 and vol / avg >= SPIKE_FACTOR
+
+    def push(self, addrs, vols):
+        if np is None:
+            return [self._push_one(a, v) for a, v in zip(addrs, vols)]
+        if not addrs:
+            return []
+        idx = np.fromiter((self._slot(a) for a in addrs), np.int64, len(addrs))
+        vol = np.asarray(vols, dtype=np.float64)
+        head = self.head[idx]
+        self.buf[idx, head] = vol
+        self.head[idx] = (head + 1) % self.window
+        count = np.minimum(self.count[idx] + 1, self.window)
+        self.count[idx] = count
+
+        # walk each window oldest -> newest so the sums add up in the same
+        # order as the per-token code (float addition is order-sensitive)
+        oldest = (head + 1 - count) % self.window
+        total = np.zeros(len(idx))
+        used = np.zeros(len(idx), dtype=np.int64)
+        for k in range(self.window):
+            x = self.buf[idx, (oldest + k) % self.window]
+            if self.mode == "pump":
+                take = (k < count - 1) & (x > 0)
+            else:
+                take = k < count
+            total = total + np.where(take, x, 0.0)
+            used += take
+
+        if self.mode == "pump":
+            avg = total / np.maximum(used, 1)
+            spike = (used > 0) & (vol >= avg * SPIKE_FACTOR)
+        else:
+            avg = total / count
+            spike = (count > 1) & (avg > 0) & (vol / np.where(avg > 0, avg, 1.0) >= SPIKE_FACTOR)
+        return spike.tolist()
+
+dex_vol_ring = VolumeRing("vol_hist", 5, "dex")
+pump_vol_ring = VolumeRing("pump_vol_hist", 4, "pump")  # current + 3 previous
+
+# --------------------------------------------------------------------------- #
+#                               HISTORY / BACKTEST                          #
+# --------------------------------------------------------------------------- #
+HISTORY_COLUMNS = (("ts", "d"), ("token", "I"), ("chain", "B"), ("liq", "f"), ("fdv", "f"), ("vol", "f"))
+HISTORY_CHAINS = ("PUMP", "SOL", "BSC")
+HISTORY_CHAIN_CODES = {c: i for i, c in enumerate(HISTORY_CHAINS)}
+
+class HistoryStore:
+    """
+    Append-only columnar log of the snapshots pushed into the volume rings,
+    so a backtest sees the per-token series the scanners saw: one raw
+    native-endian file per column (HISTORY_COLUMNS, 25 bytes a row) plus
+    tokens.txt, whose line number is the token id. Rows are buffered and written in a thread on
+    every auto-save. A flush that fails cuts every file back to where it
+    started and keeps its rows for the next one; after a crash mid-flush,
+    opening the store cuts the columns to the shortest and tokens.txt to
+    the ids those rows reference, so the columns always stay aligned.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.token_ids = None
+        self.new_tokens = []
+        self.cols = {name: array(code) for name, code in HISTORY_COLUMNS}
+
+    def _tokens_file(self):
+        return self.path / "tokens.txt"
+
+    def _col_file(self, name):
+        return self.path / f"{name}.col"
+
+    def _open(self):
+        self.path.mkdir(parents=True, exist_ok=True)
+        files = {name: self._col_file(name) for name, _ in HISTORY_COLUMNS}
+        sizes = {name: f.stat().st_size if f.exists() else 0 for name, f in files.items()}
+        rows = min(sizes[name] // array(code).itemsize for name, code in HISTORY_COLUMNS)
+        for name, code in HISTORY_COLUMNS:
+            keep = rows * array(code).itemsize
+            if sizes[name] > keep:
+                log.warning("History: cutting %s to %d rows", files[name].name, rows)
+                os.truncate(files[name], keep)
+        needed = 0
+        with open(files["token"], "ab+") as f:
+            f.seek(0)
+            while True:
+                chunk = array("I")
+                try:
+                    chunk.fromfile(f, 1 << 20)
+                except EOFError:
+                    pass
+                if not chunk:
+                    break
+                needed = max(needed, max(chunk) + 1)
+        f = self._tokens_file()
+        raw = f.read_text() if f.exists() else ""
+        lines = raw.split("\n")[:-1]  # a line without its newline is a torn write
+        if len(lines) < needed:
+            log.error("History: tokens.txt has %d of %d referenced ids", len(lines), needed)
+        elif len(raw) != sum(len(line) + 1 for line in lines[:needed]):
+            lines = lines[:needed]
+            f.write_text("".join(line + "\n" for line in lines))
+        self.token_ids = {addr: i for i, addr in enumerate(lines)}
+
+    def record(self, snaps, ts=None):
+        if self.token_ids is None:
+            self._open()
+        ts = ts or time.time()
+        cols = self.cols
+        for snap in snaps:
+            chain = HISTORY_CHAIN_CODES.get(snap.chain)
+            if chain is None:
+                continue
+            tid = self.token_ids.get(snap.addr)
+            if tid is None:
+                tid = self.token_ids[snap.addr] = len(self.token_ids)
+                self.new_tokens.append(snap.addr)
+            cols["ts"].append(ts)
+            cols["token"].append(tid)
+            cols["chain"].append(chain)
+            cols["liq"].append(snap.liq)
+            cols["fdv"].append(snap.fdv)
+            cols["vol"].append(snap.vol)
+
+    def _write(self, cols, tokens):
+        files = [self._tokens_file()] + [self._col_file(name) for name in cols]
+        sizes = [f.stat().st_size if f.exists() else 0 for f in files]
+        try:
+            # token ids first, so every written row refers to a known token
+            if tokens:
+                with open(files[0], "a") as f:
+                    f.write("\n".join(tokens) + "\n")
+            for name, values in cols.items():
+                with open(self._col_file(name), "ab") as f:
+                    values.tofile(f)
+        except OSError:
+            try:
+                for f, size in zip(files, sizes):
+                    if f.exists():
+                        os.truncate(f, size)
+            except OSError:
+                # files left in an unknown state: _open() repairs them
+                self.token_ids = None
+            raise
+
+    def _take(self):
+        cols, tokens = self.cols, self.new_tokens
+        self.cols = {name: array(code) for name, code in HISTORY_COLUMNS}
+        self.new_tokens = []
+        return cols, tokens
+
+    def _put_back(self, cols, tokens):
+        if self.token_ids is None:
+            # store will be reopened; buffered ids may not match it any more
+            self._take()
+            return
+        for name, values in cols.items():
+            values.extend(self.cols[name])
+        self.cols = cols
+        self.new_tokens = tokens + self.new_tokens
+
+    async def flush(self):
+        if len(self.cols["ts"]):
+            cols, tokens = self._take()
+            try:
+                await asyncio.to_thread(self._write, cols, tokens)
+            except OSError as e:
+                log.error("History flush error: %s", e)
+                self._put_back(cols, tokens)
+
+    def flush_sync(self):
+        if len(self.cols["ts"]):
+            cols, tokens = self._take()
+            try:
+                self._write(cols, tokens)
+            except OSError as e:
+                log.error("History flush error: %s", e)
+                self._put_back(cols, tokens)
+
+    def load(self):
+        """Memory-mapped columns (dict of numpy arrays) and the token list."""
+        cols = {}
+        for name, code in HISTORY_COLUMNS:
+            f = self._col_file(name)
+            dtype = np.dtype(code)
+            if f.exists() and f.stat().st_size >= dtype.itemsize:
+                cols[name] = np.memmap(f, dtype=dtype, mode="r")
+            else:
+                cols[name] = np.zeros(0, dtype=dtype)
+        n = min(len(c) for c in cols.values())
+        f = self._tokens_file()
+        tokens = f.read_text().splitlines() if f.exists() else []
+        return {name: c[:n] for name, c in cols.items()}, tokens
+
+history = HistoryStore(HISTORY_DIR) if HISTORY_DIR else None
+
+def rolling_spikes(group, vol, window, mode, factor):
+    """
+    VolumeRing's spike rule over a whole history at once. Rows must be
+    sorted by (group, ts); lag k looks k rows back within the same group.
+    """
+    n = len(vol)
+    total = np.zeros(n)
+    used = np.zeros(n, dtype=np.int64)
+    if mode == "dex":
+        total += vol
+        used += 1
+    for k in range(1, window):
+        prev = np.zeros(n)
+        same = np.zeros(n, dtype=bool)
+        prev[k:] = vol[:-k]
+        same[k:] = group[k:] == group[:-k]
+        take = same & (prev > 0) if mode == "pump" else same
+        total += np.where(take, prev, 0.0)
+        used += take
+    if mode == "pump":
+        return (used > 0) & (vol >= total / np.maximum(used, 1) * factor)
+    avg = total / used
+    return (used > 1) & (avg > 0) & (vol / np.where(avg > 0, avg, 1.0) >= factor)
+
+def merge_thresholds(base, override):
+    merged = {k: dict(v) for k, v in base.items()}
+    for k, v in override.items():
+        if k in merged:
+            merged[k].update(v)
+    return merged
+
+def backtest(path, sets):
+    """
+    Replay the stored history through level_codes once per threshold set.
+    As in TokenAlertState.decide, a row alerts only when its level is above
+    every earlier level of the token: the first as itself, later ones as
+    upgrades. Large buys are not stored, so DEX "max" and "large_buy" never
+    fire here.
+    """
+    t0 = time.monotonic()
+    cols, tokens = HistoryStore(path).load()
+    n = len(cols["ts"])
+    chain = cols["chain"].astype(np.int64)
+    group = (chain << 32) | cols["token"].astype(np.int64)
+    order = np.lexsort((cols["ts"], group))
+    group, chain, ts = group[order], chain[order], cols["ts"][order]
+    liq, fdv, vol = (cols[c][order].astype(np.float64) for c in ("liq", "fdv", "vol"))
+    pump = chain == HISTORY_CHAIN_CODES["PUMP"]
+    first_seen = np.zeros(n)
+    same = np.zeros(n, dtype=bool)
+    offset = np.zeros(n, dtype=np.int64)
+    if n:
+        starts = np.r_[True, group[1:] != group[:-1]]
+        gidx = np.cumsum(starts) - 1
+        first_seen = ts[starts][gidx]
+        same = ~starts
+        offset = gidx * 4  # lifts each group above every code of the one before
+    load_s = time.monotonic() - t0
+
+    report = {"rows": n, "tokens": len(tokens), "load_s": round(load_s, 3), "sets": {}}
+    if n:
+        report["span_h"] = round((ts.max() - ts.min()) / 3600, 2)
+    for name, spec in sets.items():
+        t1 = time.monotonic()
+        thresholds = merge_thresholds(ALERT_THRESHOLDS, spec)
+        factor = spec.get("spike_factor", SPIKE_FACTOR)
+        spike = np.where(
+            pump,
+            rolling_spikes(group, vol, pump_vol_ring.window, "pump", factor),
+            rolling_spikes(group, vol, dex_vol_ring.window, "dex", factor),
+        )
+        codes = level_codes(liq, fdv, vol, pump, spike, np.zeros(n, dtype=bool), True, thresholds)
+        # highest level of each token so far: a running max that restarts per group
+        top = np.maximum.accumulate(codes + offset) - offset
+        prior = np.zeros(n, dtype=np.int64)
+        prior[1:] = np.where(same[1:], top[:-1], 0)
+        alerts = np.flatnonzero(codes > prior)
+        delay = ts[alerts] - first_seen[alerts]
+        result = {"alerts": int(len(alerts)), "upgrades": int((prior[alerts] > 0).sum()), "by_level": {}, "by_chain": {}}
+        for code in (1, 2, 3):
+            result["by_level"][LEVEL_CODES[code]] = int((codes[alerts] == code).sum())
+        for code, label in enumerate(HISTORY_CHAINS):
+            result["by_chain"][label] = int((chain[alerts] == code).sum())
+        if len(alerts):
+            result["alerts_per_h"] = round(len(alerts) / max(report["span_h"], 1 / 60), 2)
+            result["delay_s"] = {q: round(float(np.percentile(delay, p)), 1) for q, p in (("p50", 50), ("p90", 90))}
+        result["elapsed_s"] = round(time.monotonic() - t1, 3)
+        result["rows_per_s"] = int(n / max(result["elapsed_s"], 1e-6))
+        report["sets"][name] = result
+    return report
+
+def backtest_cli(argv):
+    ap = argparse.ArgumentParser(prog="main.py backtest", description="Replay stored snapshots against threshold sets.")
+    ap.add_argument("--history", default=HISTORY_DIR, help="history directory (default: HISTORY_DIR)")
+    ap.add_argument("--sets", help='JSON file: {"name": {"PUMP": {...}, "DEX": {...}, "spike_factor": 2.5}}')
+    args = ap.parse_args(argv)
+    if np is None:
+        ap.error("backtests need numpy")
+    if not args.history:
+        ap.error("no history directory (--history or HISTORY_DIR)")
+    sets = {"current": {}}
+    if args.sets:
+        sets.update(json.loads(Path(args.sets).read_text()))
+    print(json.dumps(backtest(args.history, sets), indent=2))
+
 # --------------------------------------------------------------------------- #
 #                               FILTERS                                     #
 # --------------------------------------------------------------------------- #
@@ -312,6 +2322,7 @@ async def start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     influencer = source.split("_", 1)[1] if "_" in source else None
     if influencer:
         tracker.setdefault(influencer, {"joins": 0, "subs": 0, "revenue": 0.0})["joins"] += 1
+        tracker.touch(influencer)
 
     if uid not in users:
         users[uid] = {
@@ -326,6 +2337,8 @@ async def start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
     user = users[uid]
     user["chat_id"] = chat_id
+    users.touch(uid)
+    routing.update(uid)
 
     welcome_html = (
         f"<b>ONION ALERTS</b>\n\n"
@@ -349,6 +2362,7 @@ async def start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         )
         await update.message.reply_text(test, parse_mode="MarkdownV2", disable_web_page_preview=True)
         user["test_sent"] = True
+        users.touch(uid)
         log.info(f"Test alert sent in chat {chat_id}")
 
 async def testalert(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
@@ -374,32 +2388,28 @@ async def pay(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if not ctx.args:
         await update.message.reply_text("Usage: `/pay <TXID>`", parse_mode="MarkdownV2")
         return
-    txid = ctx.args[0].strip()
+    txid = ctx.args[0].strip().lower()
     uid = update.effective_user.id
+    if uid not in users:
+        await update.message.reply_text("Invalid TXID.")
+        return
     try:
-        url = f"{BSCSCAN_API}?module=account&action=tokentx&address={WALLETS['BSC']}&page=1&offset=20"
-        resp = requests.get(url, timeout=10).json()
-        for tx in resp.get("result", []):
-            if tx.get("hash", "").lower() == txid.lower() and tx.get("tokenSymbol") == "USDT":
-                value = float(tx.get("value", "0")) / 1e6
-                if value >= PRICE_USDT:
-                    users[uid]["paid"] = True
-                    users[uid]["paid_until"] = (datetime.utcnow() + timedelta(days=30)).isoformat()
-                    users[uid]["free"] = 0
-
-                    user = users[uid]
-                    source = user.get("source", "organic")
-                    influencer = source.split("_", 1)[1] if "_" in source else None
-                    if influencer:
-                        tracker.setdefault(influencer, {"joins": 0, "subs": 0, "revenue": 0.0})
-                        tracker[influencer]["subs"] += 1
-                        tracker[influencer]["revenue"] += PRICE_USDT
-
-                    await update.message.reply_text("*Payment confirmed!* Premium active.", parse_mode="MarkdownV2")
-                    return
+        tx = match_payment(await bscscan.recent_transfers(), txid)
     except Exception as e:
         log.error(f"Pay error: {e}")
-    await update.message.reply_text("Invalid TXID.")
+        tx = None
+    if tx is None:
+        pending_payments[txid] = {"uid": uid, "chat_id": update.effective_chat.id, "ts": time.time()}
+        await update.message.reply_text(
+            "TXID not found yet. It will be confirmed automatically as soon as it shows up on-chain."
+        )
+        return
+    if not confirm_payment(uid, tx):
+        await update.message.reply_text("Invalid TXID.")
+        return
+    await update.message.reply_text(
+        "*Payment confirmed\\!* Premium active\\." + channel_invite_text(uid), parse_mode="MarkdownV2"
+    )
 
 async def stats(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if not ctx.args:
@@ -425,6 +2435,7 @@ async def reset_user(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         return
     target = update.effective_user.id if not ctx.args else int(ctx.args[0])
     users.pop(target, None)
+    routing.remove(target)
     await update.message.reply_text(f"Reset user {target}")
 
 async def settings(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
@@ -432,6 +2443,8 @@ async def settings(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if uid not in users:
         users[uid] = {"free": FREE_ALERTS, "chat_id": update.effective_chat.id, "filters": {"levels": ["min","medium","max"], "chains": ["SOL","BSC","PUMP"]}}
     users[uid]["chat_id"] = update.effective_chat.id
+    users.touch(uid)
+    routing.update(uid)
     f = users[uid]["filters"]
     await update.message.reply_text(
         "*Your Alert Filters*\n\nCustomize what you receive:",
@@ -461,11 +2474,118 @@ async def button(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
                 lst.remove(item)
             else:
                 lst.append(item)
+            users.touch(uid)
+            routing.update(uid)
         await query.edit_message_reply_markup(reply_markup=build_settings_kb(f))
     elif data == "save_settings":
         await query.edit_message_text("Settings saved!")
         await query.message.reply_text("Your filters are now active.")
 
+class AdaptiveInterval:
+    """
+    Poll interval derived from the observed arrival rate of unseen tokens
+    (EWMA, tokens/s): poll roughly when `target` new ones should be waiting,
+    clamped to [lo, hi]. Repeated results drive the rate, and so the
+    polling, down.
+    """
+    def __init__(self, lo, hi, target, alpha=0.3):
+        self.lo = lo
+        self.hi = hi
+        self.target = target
+        self.alpha = alpha
+        self.rate = target / 10.0
+        self.last = None
+
+    def observe(self, fresh):
+        now = time.monotonic()
+        if self.last is not None:
+            elapsed = max(now - self.last, 1e-3)
+            self.rate = self.alpha * (fresh / elapsed) + (1 - self.alpha) * self.rate
+        self.last = now
+
+    @property
+    def interval(self):
+        if self.rate <= 0:
+            return self.hi
+        return min(self.hi, max(self.lo, self.target / self.rate))
+
+async def fetch_pump_feed(name, headers, cache):
+    # cache: name -> (etag, tokens); a 304 replays the previous result
+    url, params = PUMP_FEEDS[name]
+    hdrs = dict(headers)
+    if name in cache:
+        hdrs["If-None-Match"] = cache[name][0]
+    try:
+        resp = await http.request("moralis", "GET", url, label=f"moralis_{name.lower()}", headers=hdrs, params=params)
+        if resp.status == 304:
+            return cache[name][1]
+        if resp.status != 200:
+            log.warning("Moralis %s HTTP %s", name, resp.status)
+            return []
+        tokens = project_moralis(resp.body)
+        if resp.headers.get("ETag"):
+            cache[name] = (resp.headers["ETag"], tokens)
+        if tokens:
+            log.debug("Moralis %s Pump.fun: %d tokens", name, len(tokens))
+        else:
+            log.info("Moralis %s: empty result", name)
+        return tokens
+    except Exception as e:
+        log.warning("Moralis %s error: %s", name, e)
+        return []
+
+async def process_pump_tokens(app, tokens):
+    """Classification and alerting for one Moralis poll of pump.fun snapshots."""
+    batch = []
+    for token in tokens:
+        addr = token.addr
+        if not addr or len(addr) < 10:
+            continue
+        if addr in seen and time.time() - seen[addr] < 90:
+            continue
+        seen[addr] = time.time()
+        batch.append(token)
+
+    TOKENS_SCANNED.inc("PUMP", n=len(batch))
+    if history is not None:
+        history.record(batch)
+    spikes = pump_vol_ring.push([t.addr for t in batch], [t.vol for t in batch])
+    levels = classify_batch(batch, spikes, [False] * len(batch))
+
+    # per-token lines only at DEBUG and sampled; INFO gets one summary per poll
+    sample = LOG_TOKEN_SAMPLE if log.isEnabledFor(logging.DEBUG) else 0
+    skipped = defaultdict(int)
+    alerted = defaultdict(int)
+    for i, (token, level) in enumerate(zip(batch, levels)):
+        try:
+            addr = token.addr
+            if i < sample:
+                log.debug("%s", _debug_token(token))
+            if not level:
+                skipped[_skip_reason(token) or "below thresholds"] += 1
+                continue
+
+            state = token_state.get(addr) or TokenAlertState()
+            decision = state.decide(level, False, time.time())
+            if decision is None:
+                skipped["already sent"] += 1
+                continue
+            alert, route = decision
+            token_state[addr] = state
+
+            msg = format_alert(token, alert, route)
+
+            sent = await emit_alert(app, "PUMP", route, msg, consume_trial=alert == route)
+            alerted[alert] += 1
+
+            log.info("PUMP %s → %s (%s...) | Vol $%.0f | FDV $%.0f | Queued: %s", alert.upper(), token.sym, addr[:8], token.vol, token.fdv, sent)
+
+        except Exception as e:
+            log.error("Token process error: %s", e, exc_info=True)
+
+    if batch:
+        log.info("PUMP poll: %d tokens | alerts %s | skipped %s", len(batch), dict(alerted), dict(skipped))
+
 async def pump_scanner(app: Application):
     headers = {
         "accept": "application/json",
@@ -473,266 +2593,613 @@ async def pump_scanner(app: Application):
     }
     log.info("PUMP SCANNER: Starting with Official Moralis Pump.fun Endpoints (2025)")
 
-    volume_history = defaultdict(lambda: deque(maxlen=3))
+    poll = AdaptiveInterval(PUMP_POLL_MIN, PUMP_POLL_MAX, PUMP_POLL_TARGET_FRESH)
+    feed_cache = {}
+    prev_addrs = set()
+    polls = 0
 
-    async with aiohttp.ClientSession() as sess:
-        while True:
-            try:
-                all_tokens = []
-                seen_addrs = set()
+    while True:
+        try:
+            all_tokens = []
+            seen_addrs = set()
+
+            # === FETCH NEW + GRADUATED PUMP.FUN TOKENS (CONCURRENTLY) ===
+            feeds = await asyncio.gather(*(fetch_pump_feed(name, headers, feed_cache) for name in PUMP_FEEDS))
+            for tokens in feeds:
+                for t in tokens:
+                    addr = t.addr
+                    if addr and len(addr) >= 10 and addr not in seen_addrs:
+                        seen_addrs.add(addr)
+                        all_tokens.append(t)
+
+            poll.observe(len(seen_addrs - prev_addrs))
+            prev_addrs = seen_addrs or prev_addrs
+            polls += 1
+            if polls % PUMP_STATS_EVERY == 0:
+                for name in PUMP_FEEDS:
+                    key = f"moralis_{name.lower()}"
+                    log.info(f"Endpoint {key}: {endpoint_stats[key].summary()} | poll {poll.interval:.1f}s")
+
+            if not all_tokens:
+                log.info("Moralis Pump.fun: No tokens this cycle")
+                await asyncio.sleep(poll.interval)
+                continue
+
+                            # === PROCESS TOKENS ===
+            await process_pump_tokens(app, all_tokens)
+
+            await asyncio.sleep(poll.interval)
 
-                # === FETCH NEW PUMP.FUN TOKENS ===
-                try:
-                    params = {"limit": 50}
-                    url = "https://solana-gateway.moralis.io/token/mainnet/exchange/pumpfun/new"
-                    async with sess.get(url, headers=headers, params=params, timeout=15) as resp:
-                        if resp.status == 200:
-                            data = await resp.json()
-                            new_tokens = data.get("result", [])
-                            if new_tokens:
-                                log.info(f"Moralis NEW Pump.fun: {len(new_tokens)} tokens")
-                                for t in new_tokens:
-                                    addr = t.get("tokenAddress") or t.get("mint") or ""
-                                    addr = str(addr)[:64]
-                                    if addr and len(addr) >= 10 and addr not in seen_addrs:
-                                        seen_addrs.add(addr)
-                                        all_tokens.append(t)
-                            else:
-                                log.info("Moralis NEW: empty result")
-                        else:
-                            log.warning(f"Moralis NEW HTTP {resp.status}")
-                except Exception as e:
-                    log.warning(f"Moralis NEW error: {e}")
-
-                # === FETCH GRADUATED PUMP.FUN TOKENS ===
-                try:
-                    params = {"limit": 50, "order": "volume.desc"}
-                    url = "https://solana-gateway.moralis.io/token/mainnet/exchange/pumpfun/graduated"
-                    async with sess.get(url, headers=headers, params=params, timeout=15) as resp:
-                        if resp.status == 200:
-                            data = await resp.json()
-                            graduated = data.get("result", [])
-                            if graduated:
-                                log.info(f"Moralis GRADUATED Pump.fun: {len(graduated)} tokens")
-                                for t in graduated:
-                                    addr = t.get("tokenAddress") or t.get("mint") or ""
-                                    addr = str(addr)[:64]
-                                    if addr and len(addr) >= 10 and addr not in seen_addrs:
-                                        seen_addrs.add(addr)
-                                        all_tokens.append(t)
-                            else:
-                                log.info("Moralis GRADUATED: empty result")
-                        else:
-                            log.warning(f"Moralis GRADUATED HTTP {resp.status}")
-                except Exception as e:
-                    log.warning(f"Moralis GRADUATED error: {e}")
-
-                if not all_tokens:
-                    log.info("Moralis Pump.fun: No tokens this cycle")
-                    await asyncio.sleep(10)
-                    continue
+        except Exception as e:
+            log.error(f"PUMP SCANNER FATAL: {e}", exc_info=True)
+            await asyncio.sleep(15)
 
-                                # === PROCESS TOKENS ===
-                for token in all_tokens:
-                    try:
-                        addr = token.get("tokenAddress") or token.get("mint") or ""
-                        addr = str(addr)[:64]
-                        if not addr or len(addr) < 10:
-                            continue
+# --------------------------------------------------------------------------- #
+#                         PUMP REALTIME (WEBSOCKET)                           #
+# --------------------------------------------------------------------------- #
+WS_RECONNECT_MAX = 60
+B58_ALPHABET = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+PUMP_CREATE_DISC = hashlib.sha256(b"event:CreateEvent").digest()[:8]
+PUMP_TRADE_DISC = hashlib.sha256(b"event:TradeEvent").digest()[:8]
+PUMP_SUPPLY = 1_000_000_000        # every pump.fun mint: 1B tokens, 6 decimals
+PUMP_INITIAL_VSOL = 30 * 10**9     # virtual SOL a bonding curve starts with (lamports)
+PUMP_PENDING_TTL = 300             # seconds a launch is followed on the stream
+PUMP_WS_EVAL_INTERVAL = 0.5
+SOL_MINT = "So11111111111111111111111111111111111111112"
+SOL_PRICE_URL = MORALIS_BASE_URL + f"/token/mainnet/{SOL_MINT}/price"
+SOL_PRICE_REFRESH = 60
+
+sol_usd = float(os.getenv("SOL_USD", "150"))  # refreshed from Moralis while the stream runs
+ws_signatures = ExpiringMap("ws_signatures", 600, 50_000)
+
+def b58encode(raw):
+    n = int.from_bytes(raw, "big")
+    out = ""
+    while n:
+        n, r = divmod(n, 58)
+        out = B58_ALPHABET[r] + out
+    return "1" * (len(raw) - len(raw.lstrip(b"\0"))) + out
+
+def parse_pump_events(logs):
+    """
+    Anchor events from a pump.fun transaction's "Program data: <base64>"
+    lines: creates as (mint, symbol), trades as (mint, lamports, virtual SOL
+    reserves, virtual token reserves).
+    """
+    creates, trades = [], []
+    for line in logs:
+        if not line.startswith("Program data: "):
+            continue
+        try:
+            raw = base64.b64decode(line[14:])
+        except Exception:
+            continue
+        disc = raw[:8]
+        if disc == PUMP_CREATE_DISC:
+            # name, symbol, uri (u32 len + utf8), then the mint
+            off, fields = 8, []
+            for _ in range(3):
+                n = int.from_bytes(raw[off:off + 4], "little")
+                off += 4
+                fields.append(raw[off:off + n].decode("utf-8", "replace"))
+                off += n
+            mint = raw[off:off + 32]
+            if len(mint) == 32:
+                creates.append((b58encode(mint), fields[1]))
+        elif disc == PUMP_TRADE_DISC and len(raw) >= 113:
+            # mint, sol_amount, token_amount, is_buy, user, timestamp,
+            # virtual_sol_reserves, virtual_token_reserves, ...
+            trades.append((
+                b58encode(raw[8:40]),
+                int.from_bytes(raw[40:48], "little"),
+                int.from_bytes(raw[97:105], "little"),
+                int.from_bytes(raw[105:113], "little"),
+            ))
+    return creates, trades
+
+class PendingLaunch:
+    """
+    A mint followed on the stream from its CreateEvent: its trades give 5m
+    volume and the bonding curve's reserves give price, FDV and liquidity,
+    so it can be classified before any poll has seen it.
+    """
+    __slots__ = ("sym", "born", "trades", "vsol", "vtok", "dirty")
+
+    def __init__(self, sym, born):
+        self.sym = sym
+        self.born = born
+        self.trades = deque()  # (time, lamports)
+        self.vsol = PUMP_INITIAL_VSOL
+        self.vtok = 0
+        self.dirty = False
+
+    def trade(self, now, lamports, vsol, vtok):
+        self.trades.append((now, lamports))
+        self.vsol = vsol
+        self.vtok = vtok
+        self.dirty = True
+
+    def snapshot(self, mint, now, usd):
+        trades = self.trades
+        while trades and trades[0][0] < now - 300:
+            trades.popleft()
+        vol = sum(lamports for _, lamports in trades) / 1e9 * usd
+        price = (self.vsol / 1e9) / (self.vtok / 1e6) if self.vtok else 0.0
+        # liquidity counts both sides of the curve at the current price
+        liq = 2 * max(0, self.vsol - PUMP_INITIAL_VSOL) / 1e9 * usd
+        return TokenSnapshot("PUMP", mint, self.sym, liq, price * PUMP_SUPPLY * usd, vol, src="WS")
+
+pump_pending = ExpiringMap("pump_pending", PUMP_PENDING_TTL, 5_000)
+
+def handle_pump_logs(sig, logs, now=None):
+    """Record one stream notification; returns the number of new launches."""
+    if sig in ws_signatures:
+        PUMP_WS_EVENTS.inc("duplicate")
+        return 0
+    creates, trades = parse_pump_events(logs)
+    now = now or time.time()
+    launched = 0
+    for mint, sym in creates:
+        if mint not in pump_pending and mint not in token_state:
+            pump_pending[mint] = PendingLaunch((sym or "PUMP")[:20], now)
+            launched += 1
+    followed = 0
+    for mint, lamports, vsol, vtok in trades:
+        launch = pump_pending.get(mint)
+        if launch is not None:
+            launch.trade(now, lamports, vsol, vtok)
+            followed += 1
+    if launched or followed:
+        # only notifications that changed something need replay protection
+        ws_signatures[sig] = True
+        PUMP_WS_EVENTS.inc("create", n=launched)
+        PUMP_WS_EVENTS.inc("trade", n=followed)
+    return launched
+
+async def pump_ws_evaluate(app):
+    """
+    Every PUMP_WS_EVAL_INTERVAL, classify the followed launches that traded
+    since the last pass, through the poller's classify_batch and the shared
+    TokenAlertState. No spikes here, so the stream yields min and medium;
+    max still comes from the poller. Stream snapshots stay out of
+    pump_vol_ring and the history, which keep one sample per poll.
+    """
+    while True:
+        await asyncio.sleep(PUMP_WS_EVAL_INTERVAL)
+        now = time.time()
+        snaps, born = [], []
+        for mint, launch in list(pump_pending.items()):
+            if launch.dirty:
+                launch.dirty = False
+                snaps.append(launch.snapshot(mint, now, sol_usd))
+                born.append(launch.born)
+        if not snaps:
+            continue
+        no = [False] * len(snaps)
+        for snap, t0, level in zip(snaps, born, classify_batch(snaps, no, no)):
+            if not level:
+                continue
+            try:
+                state = token_state.get(snap.addr) or TokenAlertState()
+                decision = state.decide(level, False, now)
+                if decision is None:
+                    continue
+                alert, route = decision
+                token_state[snap.addr] = state
+                if route == "medium":
+                    # nothing higher can come from the stream
+                    if snap.addr in pump_pending:
+                        del pump_pending[snap.addr]
+                PUMP_WS_DETECT.observe(now - t0)
+                sent = await emit_alert(app, "PUMP", route, format_alert(snap, alert, route), consume_trial=alert == route)
+                log.info(
+                    "PUMP WS %s → %s (%s...) | Vol $%.0f | FDV $%.0f | %.1fs after launch | Queued: %s",
+                    alert.upper(), snap.sym, snap.addr[:8], snap.vol, snap.fdv, now - t0, sent,
+                )
+            except Exception as e:
+                log.error("PUMP WS alert error: %s", e, exc_info=True)
 
-                        if addr in seen and time.time() - seen[addr] < 90:
-                            continue
-                        seen[addr] = time.time()
-
-                        sym = str(token.get("symbol", "PUMP"))[:20]
-
-                        # === SAFE FLOATS ===
-                        def safe_float(val, default=0.0):
-                            if val is None or val == "":
-                                return default
-                            try:
-                                return float(val)
-                            except:
-                                return default
-
-                        fdv = safe_float(token.get("fullyDilutedValuation") or token.get("fdv"))
-                        liq = safe_float(token.get("liquidity"))
-                        if liq == 0 and fdv > 0:
-                            liq = fdv * 0.12
-
-                        vol_raw = token.get("volume_5m") or token.get("volume")
-                        vol = safe_float(vol_raw)
-                        if not token.get("volume_5m") and vol > 0:
-                            vol = vol / 288
-
-                        # === DEBUG LOG (NOW CORRECT) ===
-                        log.info(_debug_token(token, addr, sym, fdv, liq, vol))
-
-                        # === VOLUME SPIKE ===
-                        prev_vols = list(volume_history[addr])
-                        prev_vols.append(vol)
-                        volume_history[addr] = deque(prev_vols[-3:], maxlen=3)
-
-                        spike = False
-                        if len(prev_vols) >= 2:
-                            recent_prev = [v for v in prev_vols[:-1] if v > 0]
-                            if recent_prev:
-                                avg_prev = sum(recent_prev) / len(recent_prev)
-                                if vol >= avg_prev * 2.0:
-                                    spike = True
-
-                        level = get_alert_level(liq, fdv, vol, True, spike, False, "PUMP")
-                        if not level:
-                            continue
+async def refresh_sol_price():
+    global sol_usd
+    headers = {"accept": "application/json", "X-API-Key": MORALIS_API_KEY}
+    while True:
+        try:
+            resp = await http.request("moralis", "GET", SOL_PRICE_URL, label="moralis_sol_price", headers=headers)
+            price = safe_float(json_loads(resp.body).get("usdPrice")) if resp.status == 200 else 0.0
+            if price > 0:
+                sol_usd = price
+        except Exception as e:
+            log.warning("SOL price error: %s", e)
+        await asyncio.sleep(SOL_PRICE_REFRESH)
 
-                        state = token_state.get(addr, {"sent_levels": set()})
-                        if level in state["sent_levels"]:
-                            continue
-                        state["sent_levels"].add(level)
-                        token_state[addr] = state
-
-                        msg = format_alert("PUMP", sym, addr, liq, fdv, vol, None, level)
-
-                        sent = 0
-                        async with save_lock:
-                            for uid, u in list(users.items()):
-                                if not u.get("chat_id"):
-                                    continue
-                                chat_id = u["chat_id"]
-                                is_premium = u.get("paid") and (
-                                    not u.get("paid_until") or
-                                    datetime.fromisoformat(u["paid_until"]) > datetime.utcnow()
-                                )
-                                if u["free"] <= 0 and not is_premium:
-                                    continue
-                                f = u.get("filters", {})
-                                if level not in f.get("levels", []) or "PUMP" not in f.get("chains", []):
-                                    continue
-                                await safe_send(app, chat_id, msg)
-                                if u["free"] > 0:
-                                    u["free"] -= 1
-                                sent += 1
-
-                        log.info(f"PUMP {level.upper()} → {sym} ({addr[:8]}...) | Vol ${vol:,.0f} | FDV ${fdv:,.0f} | Sent: {sent}")
-
-                    except Exception as e:
-                        log.error(f"Token process error: {e}", exc_info=True)
-
-                await asyncio.sleep(10)
+async def pump_ws_stream():
+    backoff = 1
+    while True:
+        try:
+            async with http.ws_connect(PUMP_WS_URL) as ws:
+                await ws.send_json({
+                    "jsonrpc": "2.0", "id": 1, "method": "logsSubscribe",
+                    "params": [{"mentions": [PUMP_PROGRAM_ID]}, {"commitment": "confirmed"}],
+                })
+                log.info("PUMP WS: subscribed")
+                PUMP_WS_CONNECTS.inc()
+                backoff = 1
+                async for msg in ws:
+                    if msg.type != aiohttp.WSMsgType.TEXT:
+                        break
+                    raw = msg.data
+                    # the program is a firehose of trades: only decode creates,
+                    # and trades while some launch is being followed
+                    if "Instruction: Create" not in raw and not (
+                        pump_pending and ("Instruction: Buy" in raw or "Instruction: Sell" in raw)
+                    ):
+                        continue
+                    value = json_loads(raw).get("params", {}).get("result", {}).get("value") or {}
+                    if value.get("signature") and not value.get("err"):
+                        handle_pump_logs(value["signature"], value.get("logs") or [])
+        except Exception as e:
+            log.warning(f"PUMP WS error: {e}")
+        log.info(f"PUMP WS: reconnecting in {backoff}s")
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, WS_RECONNECT_MAX)
 
-            except Exception as e:
-                log.error(f"PUMP SCANNER FATAL: {e}", exc_info=True)
-                await asyncio.sleep(15)
+async def pump_ws_ingest(app: Application):
+    """
+    logsSubscribe on the pump.fun program. Each CreateEvent starts a
+    PendingLaunch that the stream's TradeEvents keep up to date, and
+    pump_ws_evaluate alerts on it within PUMP_WS_EVAL_INTERVAL of the trade
+    that crosses a threshold. Reconnects with backoff; notifications are
+    deduped by signature, and launches missed while disconnected are left
+    to the Moralis poller.
+    """
+    await asyncio.gather(pump_ws_stream(), pump_ws_evaluate(app), refresh_sol_price())
 
 # --------------------------------------------------------------------------- #
 #                             DEX SCANNER (LIVE)                              #
 # --------------------------------------------------------------------------- #
+DEX_CHAINS = ["solana", "bsc"]
+DEX_CYCLE = 60
+DEX_QUEUE_SIZE = 100
+DEX_SAFETY_BATCH = 20
+DEX_SAFETY_WAIT = 0.2      # seconds to fill a GoPlus micro-batch
+DEX_ENRICH_WORKERS = 8
+_DONE = object()
+
+class StageStats:
+    def __init__(self):
+        self.counts = defaultdict(int)
+
+    def inc(self, stage, what, n=1):
+        self.counts[f"{stage}.{what}"] += n
+
+    def summary(self):
+        return " ".join(f"{k}={v}" for k, v in sorted(self.counts.items()))
+
+dex_stage_stats = StageStats()
+pipeline_queues = {}  # name -> queue, for the queue-depth gauge
+
+Gauge("onion_queue_depth", "Items waiting per internal queue", ("queue",),
+      fn=lambda: {(name, ): q.qsize() for name, q in pipeline_queues.items()})
+
+async def _dex_fetch(out_q, stats):
+    queued = set()
+
+    async def one(chain):
+        url = f"{BIRDEYE_NEW_PAIRS_URL}?chain={chain}"
+        try:
+            r = await http.request("birdeye", "GET", url, label=f"birdeye_{chain}")
+            if r.status != 200:
+                return
+            pairs = project_birdeye(r.body, CHAIN_NAMES[chain])
+        except Exception as e:
+            log.error(f"BIRDEYE fetch error {chain}: {e}")
+            return
+        for p in pairs:
+            addr = p.addr
+            if not addr or not p.pair or len(p.pair) < 30:
+                continue
+            stats.inc("fetch", "out")
+            if addr in queued or (addr in seen and time.time() - seen[addr] < 300):
+                continue
+            queued.add(addr)
+            await out_q.put(p)
+
+    await asyncio.gather(*(one(c) for c in DEX_CHAINS))
+    await out_q.put(_DONE)
+
+async def _dex_safety(in_q, out_q, stats):
+    done = False
+    while not done:
+        item = await in_q.get()
+        batch = []
+        while item is not _DONE:
+            batch.append(item)
+            if len(batch) >= DEX_SAFETY_BATCH:
+                break
+            try:
+                item = await asyncio.wait_for(in_q.get(), DEX_SAFETY_WAIT)
+            except asyncio.TimeoutError:
+                break
+        done = item is _DONE
+        if not batch:
+            continue
+        stats.inc("safety", "in", len(batch))
+        per_chain = defaultdict(list)
+        for snap in batch:
+            per_chain[snap.chain].append(snap.addr)
+            TOKENS_SCANNED.inc(snap.chain)
+        safety = {}
+        for chain, addrs in per_chain.items():
+            safety.update(await is_safe_batch(addrs, chain))
+        for snap in batch:
+            if safety.get(snap.addr, False):
+                stats.inc("safety", "out")
+                await out_q.put(snap)
+    for _ in range(DEX_ENRICH_WORKERS):
+        await out_q.put(_DONE)
+
+async def _dex_enrich(in_q, out_q, rpc, stats):
+    while True:
+        item = await in_q.get()
+        if item is _DONE:
+            return
+        snap = item
+        stats.inc("enrich", "in")
+        try:
+            addr = snap.addr
+            volume_spike = track_volume(snap)
+            if history is not None:
+                history.record((snap,))
+            state = token_state.get(addr) or TokenAlertState()
+            now = time.time()
+            if state.exhausted(now):
+                # nothing can fire yet; skip the RPC lookups
+                stats.inc("enrich", "exhausted")
+                continue
+            large_buy = await detect_large_buy(addr, snap.chain, rpc)
+            level = get_alert_level(snap, True, volume_spike, large_buy)
+            if not level:
+                continue
+
+            # another alert for this token may have landed during the lookup
+            state = token_state.get(addr) or TokenAlertState()
+            decision = state.decide(level, large_buy, now)
+            if decision is None:
+                continue
+            alert, route = decision
+            token_state[addr] = state
+            seen[addr] = now
+
+            msg = format_alert(snap, alert, route)
+            stats.inc("enrich", "out")
+            await out_q.put((msg, addr, alert, route, snap.chain))
+        except Exception as e:
+            log.error(f"DEX enrich error: {e}")
+
+async def _dex_deliver(app, in_q, stats):
+    while True:
+        item = await in_q.get()
+        if item is _DONE:
+            return
+        msg, addr, alert, route, chain = item
+        stats.inc("deliver", "in")
+        try:
+            # escalations of an already-alerted token do not use up trial alerts
+            sent = await emit_alert(app, chain, route, msg, consume_trial=alert == route)
+            log.info("BIRDEYE %s → %s | Queued for %s", alert.upper(), addr, sent)
+        except Exception as e:
+            log.error(f"DEX deliver error: {e}")
+
+async def run_dex_cycle(app, rpc, stats=dex_stage_stats):
+    """
+    One Birdeye cycle as a streaming pipeline: fetch -> GoPlus safety
+    (micro-batched) -> enrichment/classification (DEX_ENRICH_WORKERS) ->
+    delivery. Bounded queues between the stages provide back-pressure, and
+    a token moves on as soon as its own stage is done with it. If a stage
+    dies, the task group cancels the others instead of leaving them blocked
+    on their queues.
+    """
+    safety_q = asyncio.Queue(DEX_QUEUE_SIZE)
+    enrich_q = asyncio.Queue(DEX_QUEUE_SIZE)
+    deliver_q = asyncio.Queue(DEX_QUEUE_SIZE)
+    pipeline_queues.update(dex_safety=safety_q, dex_enrich=enrich_q, dex_deliver=deliver_q)
+
+    async def enrich_stage():
+        async with asyncio.TaskGroup() as tg:
+            for _ in range(DEX_ENRICH_WORKERS):
+                tg.create_task(_dex_enrich(enrich_q, deliver_q, rpc, stats))
+        await deliver_q.put(_DONE)
+
+    async with asyncio.TaskGroup() as tg:
+        tg.create_task(_dex_fetch(safety_q, stats))
+        tg.create_task(_dex_safety(safety_q, enrich_q, stats))
+        tg.create_task(enrich_stage())
+        tg.create_task(_dex_deliver(app, deliver_q, stats))
+
 async def dex_scanner(app: Application):
-    async with aiohttp.ClientSession() as sess:
+    rpc = solana_rpc
+    while True:
+        try:
+            log.info("DEX SCANNER: Starting Birdeye cycle...")
+            t0 = time.monotonic()
+            await run_dex_cycle(app, rpc)
+            log.info("DEX pipeline %.1fs | %s", time.monotonic() - t0, dex_stage_stats.summary())
+            await asyncio.sleep(DEX_CYCLE)
+
+        except Exception as e:
+            log.error(f"DEX SCANNER CRASH: {e}", exc_info=True)
+            await asyncio.sleep(DEX_CYCLE)
+
+# --------------------------------------------------------------------------- #
+#                               SHARDING                                    #
+# --------------------------------------------------------------------------- #
+class ProcessBroker:
+    """
+    Topic queues between processes (publish/consume). Created before the workers
+    are forked so every process shares the same topics; blocking queue calls
+    run in a thread to keep the event loop free.
+    """
+    def __init__(self, ctx, topics, maxsize=BROKER_QUEUE_SIZE):
+        self.queues = {t: ctx.Queue(maxsize) for t in topics}
+
+    async def publish(self, topic, msg):
+        await asyncio.to_thread(self.queues[topic].put, msg)
+
+    async def consume(self, topic):
+        # short blocking gets, so a cancelled consumer never leaves a worker
+        # thread parked on the queue (asyncio.run waits for those on exit)
         while True:
             try:
-                log.info("DEX SCANNER: Starting Birdeye cycle...")
-                candidates = []
-
-                for chain in ["solana", "bsc"]:
-                    url = f"https://public-api.birdeye.so/defi/v2.0/new_pairs?chain={chain}"
-                    try:
-                        async with sess.get(url, timeout=15) as r:
-                            if r.status == 200:
-                                data = await r.json()
-                                pairs = data.get("data", {}).get("pairs", [])[:50]
-                                for p in pairs:
-                                    addr = p.get("baseToken", {}).get("address")
-                                    pair_addr = p.get("pairAddress")
-                                    if not addr or not pair_addr or len(pair_addr) < 30:
-                                        continue
-                                    candidates.append((p, chain.upper(), pair_addr))
-                    except Exception as e:
-                        log.error(f"BIRDEYE fetch error {chain}: {e}")
-
-                if not candidates:
-                    await asyncio.sleep(60)
-                    continue
+                return await asyncio.to_thread(self.queues[topic].get, True, 1.0)
+            except queue.Empty:
+                pass
 
-                addr_to_pair = {}
-                for p, chain, pair_addr in candidates:
-                    addr = p.get("baseToken", {}).get("address")
-                    if addr in seen and time.time() - seen[addr] < 300:
-                        continue
-                    addr_to_pair[addr] = (p, chain, pair_addr)
-
-                per_chain = defaultdict(list)
-                for addr, (_, chain, _) in addr_to_pair.items():
-                    per_chain[chain].append(addr)
-                safety = {}
-                for chain, addrs in per_chain.items():
-                    safety.update(await is_safe_batch(addrs, chain, sess))
-
-                alerts = []
-                for addr, (p, chain, pair_addr) in addr_to_pair.items():
-                    if not safety.get(addr, False):
-                        continue
-                    base = p.get("baseToken", {})
-                    sym = base.get("symbol", "???")[:20]
-                    liq = p.get("liquidity", {}).get("usd", 0) or 0
-                    fdv = p.get("fdv", 0) or 0
-                    vol = p.get("volume", {}).get("m5", 0) or 0
-
-                    h = vol_hist[addr]
-                    h.append(vol)
-                    spike = vol / (sum(h) / len(h)) if len(h) > 1 else 1.0
-                    volume_spike = spike >= 2.0
-                    large_buy = await detect_large_buy(addr, chain)
-                    level = get_alert_level(liq, fdv, vol, True, volume_spike, large_buy, chain)
-                    if not level:
-                        continue
+broker = None  # set in split mode; None means scanners deliver in-process
 
-                    state = token_state.get(addr, {"sent_levels": []})
-                    if level in state["sent_levels"]:
-                        if level == "max" and large_buy:
-                            level = "large_buy"
-                        elif level == "medium" and "min" in state["sent_levels"]:
-                            level = "upgrade"
-                        else:
-                            continue
+def delivery_topic(shard):
+    return f"deliver.{shard}"
+
+async def route_alerts():
+    """Bot process: resolve recipients and fan out to the delivery shards."""
+    while True:
+        chain, level, msg, consume_trial = await broker.consume("alerts")
+        shards = defaultdict(list)
+        for target in reserve_trials(routing.targets(chain, level), consume_trial):
+            shards[target[1] % DELIVERY_WORKERS].append(target)
+        for shard, targets in shards.items():
+            await broker.publish(delivery_topic(shard), (msg, level, targets, consume_trial))
+        log.info("Routed %s %s to %d chats over %d shards", level.upper(), chain, sum(map(len, shards.values())), len(shards))
+
+async def apply_delivery_reports():
+    """Bot process: give back trials whose sends a delivery worker dropped."""
+    while True:
+        uid, n = await broker.consume("refunds")
+        refund_trial(uid, n)
+
+async def delivery_main(shard):
+    # each worker gets its share of the global send rate
+    bot = Bot(BOT_TOKEN, base_url=TELEGRAM_API_URL, request=HTTPXRequest(connection_pool_size=SEND_CONCURRENCY))
+    await bot.initialize()
+    target = SimpleNamespace(bot=bot)
+    async def report(uid, n):
+        await broker.publish("refunds", (uid, n))
+
+    global delivery_queue
+    delivery_queue = DeliveryQueue(Dispatcher(rate=GLOBAL_RATE / DELIVERY_WORKERS), on_refund=report)
+    delivery_queue.start(target)
+    if METRICS_PORT:
+        asyncio.create_task(serve_metrics(METRICS_PORT + 2 + shard))
+    log.info(f"Delivery worker {shard}/{DELIVERY_WORKERS} started")
+    while True:
+        msg, level, targets, consume_trial = await broker.consume(delivery_topic(shard))
+        await delivery_queue.push(msg, level, targets, consume_trial)
+
+async def scanner_main():
+    # owns seen/token_state; users and routing stay in the bot process
+    tasks = [dex_scanner(None), pump_scanner(None), auto_save(), sweep_stores()]
+    if METRICS_PORT:
+        tasks.append(serve_metrics(METRICS_PORT + 1))
+    if PUMP_WS_URL:
+        tasks.append(pump_ws_ingest(None))
+    log.info("Scanner process started")
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        await http.close()
+        async with save_lock:
+            save_data(data)
+        if history is not None:
+            history.flush_sync()
+        store.close()
 
-                    state["sent_levels"].append(level)
-                    token_state[addr] = state
-                    seen[addr] = time.time()
+def run_worker(role, shard=None):
+    setup_logging()
+    try:
+        if role == "scanner":
+            asyncio.run(scanner_main())
+        else:
+            asyncio.run(delivery_main(shard))
+    except KeyboardInterrupt:
+        pass
 
-                    msg = format_alert(chain, sym, addr, liq, fdv, vol, pair_addr, level)
-                    alerts.append((msg, addr, level, chain))
+def start_workers():
+    """
+    Split mode: fork the scanner and delivery processes before any event
+    loop exists. Alerts flow scanner -> "alerts" -> bot (routing) ->
+    "deliver.<chat_id % DELIVERY_WORKERS>" -> worker -> "refunds" -> bot.
+    """
+    global broker
+    ctx = multiprocessing.get_context("fork")
+    topics = ["alerts", "refunds"] + [delivery_topic(i) for i in range(DELIVERY_WORKERS)]
+    broker = ProcessBroker(ctx, topics)
+    pipeline_queues.update(broker.queues)
+    procs = [ctx.Process(target=run_worker, args=("scanner",), name="scanner", daemon=True)]
+    procs += [
+        ctx.Process(target=run_worker, args=("delivery", i), name=f"delivery-{i}", daemon=True)
+        for i in range(DELIVERY_WORKERS)
+    ]
+    for proc in procs:
+        proc.start()
+    return procs
 
-                for msg, addr, level, chain in alerts:
-                    sent = 0
-                    for uid, u in list(users.items()):
-                        if "chat_id" not in u or not u["chat_id"]:
-                            continue
-                        chat_id = u["chat_id"]
-                        is_premium = u.get("paid") and (u.get("paid_until") is None or datetime.fromisoformat(u["paid_until"]) > datetime.utcnow())
-                        if u["free"] <= 0 and not is_premium:
-                            continue
-                        f = u.get("filters", {"levels": ["min","medium","max"], "chains": ["SOL","BSC","PUMP"]})
-                        if level not in f["levels"] or chain not in f["chains"]:
-                            continue
-                        await safe_send(app, chat_id, msg)
-                        if u["free"] > 0 and level not in ["large_buy", "upgrade"]:
-                            u["free"] -= 1
-                        sent += 1
-                    log.info(f"BIRDEYE {level.upper()} → {addr} | Sent to {sent}")
+# --------------------------------------------------------------------------- #
+#                               HTTP SERVER                                 #
+# --------------------------------------------------------------------------- #
+STARTED_AT = time.time()
 
-                await asyncio.sleep(60)
+def webhook_handler(app):
+    secret = WEBHOOK_SECRET.encode()
 
-            except Exception as e:
-                log.error(f"DEX SCANNER CRASH: {e}")
-                await asyncio.sleep(60)
+    async def handle(request):
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "").encode()
+        if not hmac.compare_digest(token, secret):
+            WEBHOOK_UPDATES.inc("forbidden")
+            return web.Response(status=403)
+        try:
+            update = Update.de_json(json_loads(await request.read()), app.bot)
+        except (ValueError, TypeError, KeyError, AttributeError):
+            update = None
+        if update is None:
+            WEBHOOK_UPDATES.inc("invalid")
+            return web.Response(status=400)
+        # answer at once; the handlers run off the application's update queue
+        await app.update_queue.put(update)
+        WEBHOOK_UPDATES.inc("ok")
+        return web.Response()
+    return handle
+
+async def start_http(port, app=None):
+    """/metrics and /healthz everywhere; /readyz and the webhook when app is given."""
+    async def metrics(_request):
+        return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8")
+
+    async def health(_request):
+        return web.json_response({"status": "ok", "uptime": round(time.time() - STARTED_AT)})
+
+    async def ready(_request):
+        return web.json_response({"ready": app.running}, status=200 if app.running else 503)
+
+    web_app = web.Application()
+    web_app.router.add_get("/metrics", metrics)
+    web_app.router.add_get("/healthz", health)
+    if app is not None:
+        web_app.router.add_get("/readyz", ready)
+        web_app.router.add_post(WEBHOOK_PATH, webhook_handler(app))
+    runner = web.AppRunner(web_app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, port).start()
+    log.info(f"HTTP on :{port}" + (f" (webhook {WEBHOOK_PATH})" if app is not None else ""))
+    return runner
+
+async def serve_metrics(port):
+    await start_http(port)
+    await monitor_loop_lag()
 
 # --------------------------------------------------------------------------- #
 #                               MAIN                                        #
 # --------------------------------------------------------------------------- #
-async def main():
-    app = Application.builder().token(BOT_TOKEN).build()
-
+def build_application():
+    app = Application.builder().token(BOT_TOKEN).base_url(TELEGRAM_API_URL).build()
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("testalert", testalert))
     app.add_handler(CommandHandler("force", force))
@@ -742,16 +3209,56 @@ async def main():
     app.add_handler(CommandHandler("reset", reset_user))
     app.add_handler(CommandHandler("settings", settings))
     app.add_handler(CallbackQueryHandler(button))
+    if ALERT_CHANNELS:
+        app.add_handler(ChatJoinRequestHandler(join_request))
+        app.add_handler(ChatMemberHandler(channel_member, ChatMemberHandler.CHAT_MEMBER))
+    return app
 
-    app.create_task(dex_scanner(app))
-    app.create_task(pump_scanner(app))
+async def main():
+    app = build_application()
+    routing.rebuild()
+
+    if broker is None:
+        delivery_queue.start(app)
+        app.create_task(dex_scanner(app))
+        app.create_task(pump_scanner(app))
+        if PUMP_WS_URL:
+            app.create_task(pump_ws_ingest(app))
+        app.create_task(sweep_stores())
+    else:
+        # scanners run in their own process and own seen/token_state
+        app.create_task(route_alerts())
+        app.create_task(apply_delivery_reports())
     app.create_task(auto_save())
+    app.create_task(payment_poller(app))
+    app.create_task(expire_subscriptions(app))
+    if WEBHOOK_URL or METRICS_PORT:
+        app.create_task(monitor_loop_lag())
 
     log.info("BOT STARTED – ALERTS COMING")
 
     await app.initialize()
     await app.start()
-    await app.updater.start_polling(drop_pending_updates=True, timeout=30)
+    if ALERT_CHANNELS:
+        await setup_channels(app)
+    await prune_channel_members(app)
+    # chat_member updates are only delivered when asked for explicitly
+    allowed = Update.ALL_TYPES if ALERT_CHANNELS else None
+    runners = []
+    if WEBHOOK_URL:
+        runners.append(await start_http(WEBHOOK_PORT, app))
+        await app.bot.set_webhook(
+            WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=allowed,
+            drop_pending_updates=True,
+            max_connections=SEND_CONCURRENCY,
+        )
+        log.info(f"Webhook set: {WEBHOOK_URL}")
+    else:
+        await app.updater.start_polling(drop_pending_updates=True, timeout=30, allowed_updates=allowed)
+    if METRICS_PORT and not (WEBHOOK_URL and METRICS_PORT == WEBHOOK_PORT):
+        runners.append(await start_http(METRICS_PORT))
 
     try:
         await asyncio.Event().wait()
@@ -759,11 +3266,29 @@ async def main():
         pass
     finally:
         log.info("Shutting down...")
-        await app.updater.stop()
+        if app.updater.running:
+            await app.updater.stop()
+        for runner in runners:
+            await runner.cleanup()
         await app.stop()
         await app.shutdown()
+        await http.close()
         async with save_lock:
             save_data(data)
+        if history is not None:
+            history.flush_sync()
+        store.close()
+
+def require_config():
+    for name in ("BOT_TOKEN", "MORALIS_API_KEY"):
+        if not os.getenv(name):
+            raise RuntimeError(f"{name} is required")
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["backtest"]:
+        backtest_cli(sys.argv[2:])
+        sys.exit(0)
+    require_config()
+    if RUN_MODE == "split":
+        start_workers()
     asyncio.run(main())